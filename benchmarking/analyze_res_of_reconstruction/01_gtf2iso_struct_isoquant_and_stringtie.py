@@ -1,121 +1,139 @@
 import argparse
 import os
-import shutil
+import sys
+
+from collections import defaultdict
+from itertools import chain
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_transcripts
+from flic_utils.gtf_shards import group_blocks, read_chrom_blocks
+from flic_utils.iso_store import IsoRecord, write_isoforms
+from flic_utils.parallel import map_with_shared_state
 
 
 def parser_args():
-    parser = argparse.ArgumentParser(description='This script represents isoforms from the GTF annotation as Start -> Splice sites -> End and keeps only those isoforms that are present in at least 2 repetitions for IsoQuant and StringTie results')
+    parser = argparse.ArgumentParser(description='This script represents isoforms from the GTF annotation as Start -> Splice sites -> End and keeps only those isoforms that are present in at least --min_reps repetitions for IsoQuant and StringTie results')
 
     # Add arguments
     parser.add_argument('--inp_dir', required=True, 
-                        help='Path to the input directory containing annotations in GTF format')
+                        help='Path to the input directory containing annotations in GTF format, one file per replicate')
     parser.add_argument('--ouf_path', required=True, 
-                        help='Path to the output reconstructed isoforms file')
+                        help='Path to the output reconstructed isoforms file (.npz for an isoform store)')
+    parser.add_argument('--min_reps', type=int, default=2, 
+                        help='Minimum number of replicates an isoform must be found in')
+    parser.add_argument('--end_tolerance', type=int, default=0, 
+                        help='Isoforms with the same intron chain and starts and ends within this distance (bp) '
+                             'are merged into one cluster represented by its most supported isoform, 0 for exact matches')
+    parser.add_argument('--report_support', action='store_true', 
+                        help='Add the number of supporting replicates as the last column')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of processes parsing chromosome shards of the replicates in parallel. The chromosome byte offsets are cached in a temporary directory')
 
     # Parse the arguments
     return parser.parse_args()
 
 
-def get_iso_struct(inf_path, ouf_path):
-    introns_s = set()
-    prev_start_end = tuple()
-    prev_exon_end = False
-
-    with open(ouf_path, 'w') as ouf:
-        ouf.write('')
-
-    with open(inf_path) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            if feat_type == 'transcript':
-                if prev_start_end != tuple():
-                    with open(ouf_path, 'a') as ouf:
-                        introns_s = list(introns_s)
-                        chrom, orientation, _, _ = prev_start_end
-                        ready_iso = []
-                        for elem in introns_s:
-                            _, _, start, stop = elem
-                            ready_iso.append((start, stop))
-                        ready_iso = sorted(list(ready_iso))
-                        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-                        ouf.write(f'{chrom}\t{orientation}\t{prev_start_end[2]}\t{ready_iso}\t{prev_start_end[3]}\n')
-                chrom_transcript = line_l[0]
-                orientation_transcript = line_l[6]
-                prev_start_end = (chrom_transcript, orientation_transcript, line_l[3], line_l[4])
-
-                prev_exon_end = False
-                introns_s = set()
-            if feat_type == 'exon':
-                chrom = line_l[0]
-                orientation = line_l[6]
-                start = int(line_l[3])
-                end = int(line_l[4])
-                if orientation == '+':
-                    if not prev_exon_end:
-                        prev_exon_end = end
-                    else:
-                        introns_s.add((chrom, orientation, prev_exon_end + 1, start - 1))
-                        prev_exon_end = end
-                elif orientation == '-':
-                    if not prev_exon_end:
-                        prev_exon_end = start
-                    else:
-                        introns_s.add((chrom, orientation, end + 1, prev_exon_end - 1))
-                        prev_exon_end = start
-
-    with open(ouf_path, 'a') as ouf:
-        introns_s = list(introns_s)
-        chrom, orientation, _, _ = prev_start_end
-        ready_iso = []
-        for elem in introns_s:
-            _, _, start, stop = elem
-            ready_iso.append((start, stop))
-        ready_iso = sorted(list(ready_iso))
-        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-        ouf.write(f'{chrom}\t{orientation}\t{prev_start_end[2]}\t{ready_iso}\t{prev_start_end[3]}\n')
-        
-        
-def comb_by_splice_sites(fpath, d_of_iso, idx):
-    with open(fpath) as inf:
-        for line in inf:
-            line = line.replace(' ', '\t')
-            iso_splice_sites_only = line
-            
-            if iso_splice_sites_only not in d_of_iso.keys():
-                d_of_iso[iso_splice_sites_only] = [0, 0, 0]
-            d_of_iso[iso_splice_sites_only][idx] += 1
-    
-    return d_of_iso
-
-
-def keep_iso_in_2reps_min(d_of_iso, ouf_path):
-    with open(ouf_path, 'w') as ouf:
-        for key, val in d_of_iso.items():
-            if sum([x >= 1 for x in val]) > 1:
-                ouf.write(key)
-
-                
-def main(inp_dir, ouf_path):
-    tmp_dir = './tmp/'
-    os.mkdir(tmp_dir)
-    
-    d_of_iso = {}
-    
-    for idx, file in enumerate(sorted(os.listdir(inp_dir))):
-        inf_path = os.path.join(inp_dir, file)
-        tmp_fpath = os.path.join(tmp_dir, file.replace('.gtf', '.tsv'))
-        get_iso_struct(inf_path, tmp_fpath)
-        
-        d_of_iso = comb_by_splice_sites(tmp_fpath, d_of_iso, idx)
-        
-    
-    keep_iso_in_2reps_min(d_of_iso, ouf_path)
-    shutil.rmtree(tmp_dir)
+def read_iso_keys(_, inf_path, byte_range=None):
+    '''
+    Distinct (chrom, strand, start, introns, end) isoforms of a GTF or of a byte range of it, in the file order
+    '''
+    return list(dict.fromkeys((transcript.chrom, transcript.strand, transcript.start, transcript.introns, transcript.end)
+                              for transcript in iter_transcripts(inf_path, byte_range=byte_range)))
+
+
+def get_replicate_tasks(l_fpaths, n_jobs, shards_per_job=4):
+    '''
+    (replicate index, (inf_path, byte_range)) tasks, with n_jobs > 1 every replicate is split into chromosome shards
+    '''
+    l_tasks = []
+    for rep_idx, inf_path in enumerate(l_fpaths):
+        if n_jobs > 1:
+            l_byte_ranges = group_blocks(read_chrom_blocks(inf_path), n_jobs * shards_per_job)
+        else:
+            l_byte_ranges = [None]
+        l_tasks.extend((rep_idx, (inf_path, byte_range)) for byte_range in l_byte_ranges)
+    return l_tasks
+
+
+def collect_replicate_masks(l_fpaths, n_jobs=1):
+    '''
+    {isoform key: bit mask of the replicates containing it} in the order of the first appearance,
+    replicates are parsed in parallel
+    '''
+    l_tasks = get_replicate_tasks(l_fpaths, n_jobs)
+    l_keys = map_with_shared_state(read_iso_keys, None, [args for _, args in l_tasks], n_jobs)
+
+    l_rep_keys = [[] for _ in l_fpaths]
+    for (rep_idx, _), keys in zip(l_tasks, l_keys):
+        l_rep_keys[rep_idx].append(keys)
+
+    d_masks = {}
+    for rep_idx, rep_keys in enumerate(l_rep_keys):
+        for key in chain.from_iterable(rep_keys):
+            d_masks[key] = d_masks.get(key, 0) | 1 << rep_idx
+    return d_masks
+
+
+def count_reps(rep_mask):
+    return bin(rep_mask).count('1')
+
+
+def split_by_tolerance(members_l, coord_idx, tolerance):
+    '''
+    Sorted sweep over one coordinate: a new group starts where the gap to the previous member exceeds tolerance
+    '''
+    members_l = sorted(members_l, key=lambda x: x[coord_idx])
+    groups_l = [[members_l[0]]]
+    for prev, cur in zip(members_l, members_l[1:]):
+        if cur[coord_idx] - prev[coord_idx] > tolerance:
+            groups_l.append([])
+        groups_l[-1].append(cur)
+    return groups_l
+
+
+def cluster_isoforms(d_masks, tolerance):
+    '''
+    Groups the isoforms by exact (chrom, strand, intron chain), then splits every group by sorted sweeps
+    over starts and over ends. Returns [(representative key, replicate mask of the cluster), ...]
+    in the order of the first appearance, the representative is the isoform found in most replicates
+    '''
+    if tolerance <= 0:
+        return list(d_masks.items())
+
+    d_chains = defaultdict(list)
+    for order, ((chrom, strand, start, introns, end), rep_mask) in enumerate(d_masks.items()):
+        d_chains[chrom, strand, introns].append((order, start, end, rep_mask))
+
+    clusters_l = []
+    for (chrom, strand, introns), members_l in d_chains.items():
+        for start_group in split_by_tolerance(members_l, 1, tolerance):
+            for cluster in split_by_tolerance(start_group, 2, tolerance):
+                order, start, end, _ = max(cluster, key=lambda x: (count_reps(x[3]), -x[0]))
+                cluster_mask = 0
+                for member in cluster:
+                    cluster_mask |= member[3]
+                clusters_l.append((min(member[0] for member in cluster), (chrom, strand, start, introns, end),
+                                   cluster_mask))
+
+    clusters_l.sort()
+    return [(key, cluster_mask) for _, key, cluster_mask in clusters_l]
+
+
+def iter_consensus_isoforms(clusters_l, min_reps, report_support=False):
+    for (chrom, strand, start, introns, end), rep_mask in clusters_l:
+        n_reps = count_reps(rep_mask)
+        if n_reps >= min_reps:
+            tail = [str(n_reps)] if report_support else []
+            yield IsoRecord(chrom, strand, (start, start), introns, (end, end), tail, False)
+
+
+def main(inp_dir, ouf_path, n_jobs=1, min_reps=2, tolerance=0, report_support=False):
+    l_fpaths = [os.path.join(inp_dir, file) for file in sorted(os.listdir(inp_dir))]
+    clusters_l = cluster_isoforms(collect_replicate_masks(l_fpaths, n_jobs), tolerance)
+    write_isoforms(iter_consensus_isoforms(clusters_l, min_reps, report_support), ouf_path)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.inp_dir, args.ouf_path)
+    main(args.inp_dir, args.ouf_path, args.jobs, args.min_reps, args.end_tolerance, args.report_support)
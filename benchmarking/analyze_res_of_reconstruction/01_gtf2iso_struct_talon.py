@@ -1,4 +1,11 @@
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_transcripts
+from flic_utils.gtf_shards import convert_by_chrom_shards
+from flic_utils.iso_store import iso_from_transcript, write_isoforms
 
 
 def parser_args():
@@ -6,73 +13,26 @@ def parser_args():
     parser.add_argument('--inf_path', required=True, 
                         help='Path to the input GTF file')
     parser.add_argument('--ouf_path', required=True, 
-                        help='Path to the output reconstructed isoforms file')
+                        help='Path to the output reconstructed isoforms file, a .npz path writes a binary isoform store')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of processes converting chromosome shards of the GTF in parallel. The chromosome byte offsets are cached in a temporary directory')
 
     return parser.parse_args()
 
 
-def get_iso_struct(inf_path, ouf_path):
-    prev_exon_end = False
-    introns_s = set()
-    prev_start_end = tuple()
-
-    with open(ouf_path, 'w') as ouf:
-        ouf.write('')
+def get_iso_struct(inf_path, ouf_path, byte_range=None):
+    write_isoforms((iso_from_transcript(transcript) for transcript in iter_transcripts(inf_path, byte_range=byte_range)),
+                   ouf_path)
 
-    with open(inf_path) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            if feat_type == 'transcript':
-                if prev_start_end != tuple():
-                    with open(ouf_path, 'a') as ouf:
-                        introns_s = list(introns_s)
-                        chrom, orientation, _, _ = prev_start_end
-                        ready_iso = []
-                        for elem in introns_s:
-                            _, _, start, stop = elem
-                            ready_iso.append((start, stop))
-                        ready_iso = sorted(list(ready_iso))
-                        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-                        ouf.write(f'{chrom}\t{orientation}\t{prev_start_end[2]}\t{ready_iso}\t{prev_start_end[3]}\n')
-                chrom_transcript = line_l[0]
-                orientation_transcript = line_l[6]
-                prev_start_end = (chrom_transcript, orientation_transcript, line_l[3], line_l[4])
 
-                prev_exon_end = False
-                introns_s = set()
-            if feat_type == 'exon':
-                chrom = line_l[0]
-                orientation = line_l[6]
-                start = int(line_l[3])
-                end = int(line_l[4])
-                if orientation == '+':
-                    if not prev_exon_end:
-                        prev_exon_end = end
-                    else:
-                        introns_s.add((chrom, orientation, prev_exon_end + 1, start - 1))
-                        prev_exon_end = end
-                elif orientation == '-':
-                    if not prev_exon_end:
-                        prev_exon_end = start
-                    else:
-                        introns_s.add((chrom, orientation, end + 1, prev_exon_end - 1))
-                        prev_exon_end = start
 
-    with open(ouf_path, 'a') as ouf:
-        introns_s = list(introns_s)
-        chrom, orientation, _, _ = prev_start_end
-        ready_iso = []
-        for elem in introns_s:
-            _, _, start, stop = elem
-            ready_iso.append((start, stop))
-        ready_iso = sorted(list(ready_iso))
-        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-        ouf.write(f'{chrom}\t{orientation}\t{prev_start_end[2]}\t{ready_iso}\t{prev_start_end[3]}\n')
+def main(inf_path, ouf_path, n_jobs=1):
+    if n_jobs > 1:
+        convert_by_chrom_shards(get_iso_struct, inf_path, ouf_path, n_jobs)
+    else:
+        get_iso_struct(inf_path, ouf_path)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    get_iso_struct(args.inf_path, args.ouf_path)
+    main(args.inf_path, args.ouf_path, args.jobs)
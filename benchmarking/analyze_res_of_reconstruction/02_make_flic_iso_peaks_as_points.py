@@ -1,5 +1,11 @@
 import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.iso_store import format_coord, format_iso_line, iter_isoforms
+from flic_utils.peaks import build_peak_indexes, iter_cagefightr_peaks
+from flic_utils.writers import AtomicWriter
 
 
 def parser_args():
@@ -9,59 +15,54 @@ def parser_args():
     parser.add_argument('--cagefightr_pa', required=True, 
                         help='Path to the CAGEfigthR PAs')
     parser.add_argument('--isoform_fpath', required=True, 
-                        help='Path to the file containing reconstructed FLIC isoforms')
+                        help='Path to the file containing reconstructed FLIC isoforms (TSV or .npz isoform store)')
     parser.add_argument('--ouf_path', required=True, 
                         help='Path to the output file')
+    parser.add_argument('--peak_match', choices=['exact', 'contain'], default='exact', 
+                        help='How isoform borders are matched to the peaks: exact peak borders, or the peak '
+                             'containing the isoform border when there is no exact match (other peak callers)')
 
     return parser.parse_args()
 
 
-def get_max_tss_pa_peaks(inf_fpath, d_tss_w_max, d_polya_w_max):
-    with open(inf_fpath) as inf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            chrom = line_l[0]
-            orientation = line_l[5]
-            start_peak = int(line_l[1]) + 1
-            end_peak = int(line_l[2])
-            max_start_peak = int(line_l[6]) + 1
-            max_end_peak = int(line_l[7])
-            max_peak = int(round((max_end_peak - max_start_peak) / 2 + max_start_peak, 0))
+def read_border_peaks(inf_fpath_start, inf_fpath_end):
+    '''
+    Peaks of the left and of the right isoform border by (chrom, strand):
+    TSS on the plus strand and PA on the minus strand are left borders, the others are right borders
+    '''
+    left_peaks_l, right_peaks_l = [], []
+    for peak in iter_cagefightr_peaks(inf_fpath_start):
+        (left_peaks_l if peak[1] == '+' else right_peaks_l).append(peak)
+    for peak in iter_cagefightr_peaks(inf_fpath_end):
+        (right_peaks_l if peak[1] == '+' else left_peaks_l).append(peak)
+    return build_peak_indexes(left_peaks_l), build_peak_indexes(right_peaks_l)
+
+
+def find_summit(peak_index, coord, peak_match):
+    summit = peak_index.find_exact(*coord)
+    if summit is None and peak_match == 'contain':
+        summit = peak_index.find_containing(*coord)
+    return summit
+
+
+def write_max_peaks_by_iso(d_left_peaks, d_right_peaks, isoform_fpath, ouf_path, peak_match='exact'):
+    with AtomicWriter(ouf_path) as ouf:
+        for iso in iter_isoforms(isoform_fpath):
+            max_start = find_summit(d_left_peaks[iso.chrom, iso.strand], iso.start, peak_match)
+            max_end = find_summit(d_right_peaks[iso.chrom, iso.strand], iso.end, peak_match)
+            if max_start is None or max_end is None:
+                raise ValueError(f'No {peak_match} peak for the isoform borders {iso.chrom} {iso.strand} '
+                                 f'{format_coord(iso.start, iso.is_peak)} {format_coord(iso.end, iso.is_peak)}')
 
-            if orientation == '+':
-                d_tss_w_max[f'{chrom}*{orientation}*{start_peak}-{end_peak}'] = max_peak
-            else:
-                d_polya_w_max[f'{chrom}*{orientation}*{start_peak}-{end_peak}'] = max_peak
-    return d_tss_w_max, d_polya_w_max
+            ouf.write(format_iso_line(iso._replace(start=(max_start, max_start), end=(max_end, max_end),
+                                                   tail=iso.tail[:-1], is_peak=False)))
 
 
-def write_max_peaks_by_iso(d_tss_w_max, d_polya_w_max, isoform_fpath, ouf_path):
-    with open(ouf_path, 'w') as ouf:
-        ouf.write('')
-        
-    d_isoforms_w_max_peaks = {}
-    with open(isoform_fpath) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            *line_l, _ = line.strip('\n').split('\t')
-            iso_start_info = f'{line_l[0]}*{line_l[1]}*{line_l[2]}'
-            iso_end_info = f'{line_l[0]}*{line_l[1]}*{line_l[4]}'
-            line_l[2] = str(d_tss_w_max[iso_start_info])
-            line_l[4] = str(d_polya_w_max[iso_end_info])
-            
-            with open(ouf_path, 'a') as ouf:
-                ouf.write('\t'.join(line_l) + '\n')
-   
-            
-def main(inf_fpath_start, inf_fpath_end, isoform_fpath, ouf_path):
-    d_tss_w_max = {}
-    d_polya_w_max = {}
-    d_tss_w_max, d_polya_w_max = get_max_tss_pa_peaks(inf_fpath_start, d_tss_w_max, d_polya_w_max)
-    d_polya_w_max, d_tss_w_max = get_max_tss_pa_peaks(inf_fpath_end, d_polya_w_max, d_tss_w_max)
-    write_max_peaks_by_iso(d_tss_w_max, d_polya_w_max, isoform_fpath, ouf_path)
+def main(inf_fpath_start, inf_fpath_end, isoform_fpath, ouf_path, peak_match='exact'):
+    d_left_peaks, d_right_peaks = read_border_peaks(inf_fpath_start, inf_fpath_end)
+    write_max_peaks_by_iso(d_left_peaks, d_right_peaks, isoform_fpath, ouf_path, peak_match)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.cagefightr_tss, args.cagefightr_pa, args.isoform_fpath, args.ouf_path)
+    main(args.cagefightr_tss, args.cagefightr_pa, args.isoform_fpath, args.ouf_path, args.peak_match)
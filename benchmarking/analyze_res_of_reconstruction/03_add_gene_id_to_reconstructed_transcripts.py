@@ -1,49 +1,51 @@
 import argparse
 import os
-import re
+import sys
 
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_gtf, parse_attributes
+from flic_utils.interval_index import build_index_by_key
+from flic_utils.iso_store import iter_isoforms, write_isoforms
+from flic_utils.parallel import map_with_shared_state
+
 
 def parser_args():
     parser = argparse.ArgumentParser(description='This script adds gene IDs to transcripts based on the provided GTF annotation')
 
     parser.add_argument('--inp_dir', required=True, 
-                        help='Path to the input directory containing reconstructed isoforms')
+                        help='Path to the input directory containing reconstructed isoforms (TSV or .npz isoform stores)')
     parser.add_argument('--annot_fpath', required=True, 
                         help='Path to the reference GTF annotation file')
     parser.add_argument('--out_dir', required=True, 
                         help='Path to the output directory')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of input files processed in parallel')
 
     return parser.parse_args()
 
 
 def read_annot_file(annot_file):
     d_of_annot_genes = defaultdict(dict)
-    with open(annot_file) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            line_l = line.strip('\n').split('\t')
-            feat_id = line_l[2]
-            if feat_id == 'gene':
-                chrom_and_orientation = f'{line_l[0]}*{line_l[6]}'
-                start = int(line_l[3])
-                stop = int(line_l[4])
-                gene_id = re.findall(r'gene_id "(.+?)"', line_l[8])[0]
-                d_of_annot_genes[chrom_and_orientation][(start, stop)] = gene_id
-                
-    return d_of_annot_genes
-
-
-def intersection_with_genes(gene_coords, d_of_ref):
+    for line_l in iter_gtf(annot_file):
+        feat_id = line_l[2]
+        if feat_id == 'gene':
+            chrom_and_orientation = f'{line_l[0]}*{line_l[6]}'
+            start = int(line_l[3])
+            stop = int(line_l[4])
+            gene_id = parse_attributes(line_l[8])['gene_id']
+            d_of_annot_genes[chrom_and_orientation][(start, stop)] = gene_id
+
+    return build_index_by_key(d_of_annot_genes)
+
+
+def intersection_with_genes(gene_coords, genes_index):
     start_gene, stop_gene = gene_coords
     best_gene = 'unassigned_gene'
     best_prop_intersection = 0
     
-    for key, gene_id in d_of_ref.items():
-        start_ref, stop_ref = key
-
+    for start_ref, stop_ref, gene_id in genes_index.overlaps(start_gene, stop_gene):
         max_start = max(start_ref, start_gene)
         min_end = min(stop_ref, stop_gene)
         min_length = min(stop_ref - start_ref,
@@ -60,37 +62,27 @@ def intersection_with_genes(gene_coords, d_of_ref):
     return best_gene
 
 
-def add_gene_ids(inf_path, d_of_annot_genes, ouf_path):
-    n_uniassigned_genes = 0
-    
-    with open(inf_path) as inf, open(ouf_path, 'w') as ouf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            line_l = line_l[:5]
-            chrom_and_orientation = f'{line_l[0]}*{line_l[1]}'
-            if '-' in line_l[2]:
-                start = int(line_l[2].split('-')[0])
-                stop = int(line_l[4].split('-')[1])
-            else:
-                start = int(line_l[2])
-                stop = int(line_l[4])
-                
-            gene_id = intersection_with_genes((start, stop), d_of_annot_genes[chrom_and_orientation])
-            line_l.append(gene_id)
-
-            ouf.write('\t'.join(line_l) + '\n')
+def iter_isoforms_w_gene_ids(d_of_annot_genes, inf_path):
+    for iso in iter_isoforms(inf_path):
+        chrom_and_orientation = f'{iso.chrom}*{iso.strand}'
+        gene_id = intersection_with_genes((iso.start[0], iso.end[1]), d_of_annot_genes[chrom_and_orientation])
+        yield iso._replace(tail=[gene_id])
+
+
+def add_gene_ids(d_of_annot_genes, inf_path, ouf_path):
+    write_isoforms(iter_isoforms_w_gene_ids(d_of_annot_genes, inf_path), ouf_path)
 
             
-def main(inp_dir, annot_fpath, out_dir):
+def main(inp_dir, annot_fpath, out_dir, n_jobs=1):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
     d_of_annot_genes = read_annot_file(annot_fpath)
     
-    for file in os.listdir(inp_dir):
-        add_gene_ids(os.path.join(inp_dir, file), d_of_annot_genes, os.path.join(out_dir, file))
+    l_tasks = [(os.path.join(inp_dir, file), os.path.join(out_dir, file)) for file in sorted(os.listdir(inp_dir))]
+    map_with_shared_state(add_gene_ids, d_of_annot_genes, l_tasks, n_jobs)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.inp_dir, args.annot_fpath, args.out_dir)
+    main(args.inp_dir, args.annot_fpath, args.out_dir, args.jobs)
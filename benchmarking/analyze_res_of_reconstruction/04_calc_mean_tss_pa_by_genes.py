@@ -1,7 +1,12 @@
 import argparse
-import re
+import os
+import sys
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_gtf, parse_attributes
+from flic_utils.writers import AtomicWriter
 
 
 def parser_args():
@@ -14,77 +19,144 @@ def parser_args():
                         help='Path to the CAGEfigthR PAs')
     parser.add_argument('--ouf_path', required=True, 
                         help='Path to the output file for peak width by genes')
+    parser.add_argument('--stat', choices=['max', 'mean', 'median'], default='max', 
+                        help='Statistic of the widths of the peaks assigned to a gene, rounded to an integer')
 
     return parser.parse_args()
 
 
+class GeneSweep:
+    '''
+    Genes of one chromosome strand swept along peaks sorted by start: genes are activated when they start
+    before the peak end and dropped once they end before the peak start. A peak is assigned to the
+    intersecting gene that comes first in the annotation
+    '''
+    def __init__(self, genes=()):
+        self.genes = sorted((start, stop, order, gene_id) for order, (start, stop, gene_id) in enumerate(genes))
+        self.reset()
+
+    def reset(self):
+        self.next_idx = 0
+        self.active = []
+        self.last_peak_start = None
+
+    def find_gene(self, peak_start, peak_stop):
+        if self.last_peak_start is not None and peak_start < self.last_peak_start:
+            raise ValueError(f'Peaks are not sorted by start: {peak_start} after {self.last_peak_start}, '
+                             f'sort the BED file first, e.g. with sort -k1,1 -k2,2n')
+        self.last_peak_start = peak_start
+
+        while self.next_idx < len(self.genes) and self.genes[self.next_idx][0] < peak_stop:
+            self.active.append(self.genes[self.next_idx])
+            self.next_idx += 1
+        self.active = [gene for gene in self.active if gene[1] > peak_start]
+
+        best_gene = None
+        for gene in self.active:
+            if gene[0] < peak_stop and (best_gene is None or gene[2] < best_gene[2]):
+                best_gene = gene
+        return 'unassigned_gene' if best_gene is None else best_gene[3]
+
+
+class WidthStat:
+    '''
+    Running statistic of the peak widths of one gene, for the median only the width counts are kept
+    '''
+    def __init__(self, stat):
+        self.stat = stat
+        self.n = 0
+        self.total = 0
+        self.max = None
+        self.d_counts = Counter()
+
+    def add(self, width):
+        self.n += 1
+        self.total += width
+        if self.max is None or width > self.max:
+            self.max = width
+        if self.stat == 'median':
+            self.d_counts[width] += 1
+
+    def get(self):
+        if self.stat == 'max':
+            return self.max
+        if self.stat == 'mean':
+            return int(round(self.total / self.n, 0))
+
+        middle_l = []
+        n_seen = 0
+        for width in sorted(self.d_counts):
+            n_seen += self.d_counts[width]
+            while len(middle_l) < 2 and n_seen > (self.n - 1) // 2 + len(middle_l):
+                middle_l.append(width)
+        if self.n % 2:
+            return middle_l[0]
+        return int(round((middle_l[0] + middle_l[1]) / 2, 0))
+
+
 def read_annot_file(ref_annot_fpath):
+    '''
+    {chrom*strand: GeneSweep} and gene ids in the annotation order
+    '''
     d_gene_borders = defaultdict(dict)
-    with open(ref_annot_fpath) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            
-            line_l = line.strip('\n').split('\t')
-            if line_l[2] == 'gene':
-                chrom_and_orientation = f'{line_l[0]}*{line_l[6]}'
-                start = int(line_l[3])
-                stop = int(line_l[4])
-                gene_id = re.findall(r'gene_id "(.+?)"', line_l[8])[0]
-                d_gene_borders[chrom_and_orientation][(start, stop)] = gene_id
-    
-    return d_gene_borders
-
-
-def intersection_with_genes(gene_coords, d_of_ref):
-    start_gene, stop_gene = gene_coords
-    
-    for key, gene_id in d_of_ref.items():
-        start_ref, stop_ref = key
-
-        max_start = max(start_ref, start_gene)
-        min_end = min(stop_ref, stop_gene)
-        prop_intersection = min_end - max_start
-        
-        if prop_intersection > 0:
-            return gene_id   
-    return 'unassigned_gene'
-
-
-def find_mean_peak_width_by_gene(cage_fpath, d_gene_borders):
-    d_peaks_len_by_genes = {}
+    gene_ids_l = []
+    for line_l in iter_gtf(ref_annot_fpath):
+        if line_l[2] == 'gene':
+            chrom_and_orientation = f'{line_l[0]}*{line_l[6]}'
+            start = int(line_l[3])
+            stop = int(line_l[4])
+            gene_id = parse_attributes(line_l[8])['gene_id']
+            d_gene_borders[chrom_and_orientation][(start, stop)] = gene_id
+            gene_ids_l.append(gene_id)
+
+    d_sweeps = defaultdict(GeneSweep)
+    for key, d_genes in d_gene_borders.items():
+        d_sweeps[key] = GeneSweep([(start, stop, gene_id) for (start, stop), gene_id in d_genes.items()])
+    return d_sweeps, list(dict.fromkeys(gene_ids_l))
+
+
+def find_peak_width_by_gene(cage_fpath, d_sweeps, stat='max'):
+    '''
+    Returns {gene_id: statistic of the assigned peak widths} and the number of unassigned peaks.
+    The position-sorted BED file is streamed, every peak is merged with the genes of its chromosome strand
+    '''
+    for sweep in d_sweeps.values():
+        sweep.reset()
+    d_width_stat_by_genes = {}
     n_unassigned_peaks = 0
 
     with open(cage_fpath) as inf:
         for line in inf:
             line_l = line.strip('\n').split('\t')
-            chrom_and_orientation = f'{line_l[0]}*{line_l[5]}'
             peak_start = int(line_l[1])
             peak_stop = int(line_l[2])
-            gene_id = intersection_with_genes((peak_start, peak_stop), d_gene_borders[chrom_and_orientation])
+            gene_id = d_sweeps[f'{line_l[0]}*{line_l[5]}'].find_gene(peak_start, peak_stop)
 
             if gene_id == 'unassigned_gene':
                 n_unassigned_peaks += 1
             else:
-                if gene_id not in d_peaks_len_by_genes.keys():
-                    d_peaks_len_by_genes[gene_id] = []
-                d_peaks_len_by_genes[gene_id].append(peak_stop - peak_start)
+                if gene_id not in d_width_stat_by_genes:
+                    d_width_stat_by_genes[gene_id] = WidthStat(stat)
+                d_width_stat_by_genes[gene_id].add(peak_stop - peak_start)
 
-    return {key: max(values) for key, values in d_peaks_len_by_genes.items()}
+    return {key: width_stat.get() for key, width_stat in d_width_stat_by_genes.items()}, n_unassigned_peaks
 
 
-def main(ref_annot_fpath, cage_start_fpath, cage_pa_fpath, ouf_path):
-    d_gene_borders = read_annot_file(ref_annot_fpath)
-    d_max_tss_by_genes = find_mean_peak_width_by_gene(cage_start_fpath, d_gene_borders)
-    d_max_pa_by_genes = find_mean_peak_width_by_gene(cage_pa_fpath, d_gene_borders)
-    common_genes = set(d_max_tss_by_genes.keys()) & set(d_max_pa_by_genes.keys())
+def main(ref_annot_fpath, cage_start_fpath, cage_pa_fpath, ouf_path, stat='max'):
+    d_sweeps, gene_ids_l = read_annot_file(ref_annot_fpath)
+    d_tss_by_genes, n_unassigned_tss = find_peak_width_by_gene(cage_start_fpath, d_sweeps, stat)
+    d_pa_by_genes, n_unassigned_pa = find_peak_width_by_gene(cage_pa_fpath, d_sweeps, stat)
 
-    with open(ouf_path, 'w') as ouf:
+    with AtomicWriter(ouf_path) as ouf:
         ouf.write('#gene_id\tTSS_width\tPA_width\n')
-        for gene_id in common_genes:
-            ouf.write(f'{gene_id}\t{d_max_tss_by_genes[gene_id]}\t{d_max_pa_by_genes[gene_id]}\n')
+        for gene_id in gene_ids_l:
+            if gene_id in d_tss_by_genes and gene_id in d_pa_by_genes:
+                ouf.write(f'{gene_id}\t{d_tss_by_genes[gene_id]}\t{d_pa_by_genes[gene_id]}\n')
+
+    print(f'Unassigned TSS peaks\t{n_unassigned_tss}', file=sys.stderr)
+    print(f'Unassigned PA peaks\t{n_unassigned_pa}', file=sys.stderr)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.ref_annot_fpath, args.cagefightr_tss, args.cagefightr_pa, args.ouf_path)
+    main(args.ref_annot_fpath, args.cagefightr_tss, args.cagefightr_pa, args.ouf_path, args.stat)
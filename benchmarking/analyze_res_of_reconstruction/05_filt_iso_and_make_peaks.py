@@ -1,5 +1,13 @@
 import argparse
 import os
+import sys
+
+from contextlib import ExitStack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.parallel import map_with_shared_state
+from flic_utils.iso_store import IsoformWriter, iter_isoforms
+from flic_utils.peaks import read_peak_width
 
 
 def parser_args():
@@ -10,59 +18,61 @@ def parser_args():
                         help='Path to the input directory containing isoform structures')
     parser.add_argument('--out_dir', required=True, 
                         help='Path to the output directory')
+    parser.add_argument('--points_out_dir', default=None, 
+                        help='Path to the output directory for the same isoforms with point peaks '
+                             '(the output of 05_filt_iso_and_make_peaks_len_eq1.py), written in the same pass')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of input files processed in parallel')
 
     return parser.parse_args()
 
 
-def read_peak_width(peak_width_fpath):
-    d_peak_width_by_genes = {}
-    with open(peak_width_fpath) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            gene_id, tss, pa = line.strip('\n').split('\t')
-            d_peak_width_by_genes[gene_id] = (int(round(int(tss) / 2, 0)), int(round(int(pa) / 2, 0)))
-    
-    return d_peak_width_by_genes
-
+def make_peak_windows(iso, start_width, end_width):
+    '''
+    Point borders -> start +- start_width and end +- end_width in the transcript orientation
+    '''
+    if iso.strand != '+':
+        start_width, end_width = end_width, start_width
+    start = iso.start[0]
+    end = iso.end[0]
+    return iso._replace(start=(start - start_width, start + start_width), end=(end - end_width, end + end_width),
+                        is_peak=True)
 
-def create_peaks(inf_path, out_dir, d_peak_width_by_genes):
-    ouf_path = os.path.join(out_dir, os.path.basename(inf_path))
 
-    with open(inf_path) as inf, open(ouf_path, 'w') as ouf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            gene_id = line_l[-1]
-            if gene_id in d_peak_width_by_genes.keys():
-                if not '-' in line_l[2]:
-                    strand = line_l[1]
-                    if strand == '+':
-                        start_start = int(line_l[2]) - d_peak_width_by_genes[gene_id][0]
-                        start_end = int(line_l[2]) + d_peak_width_by_genes[gene_id][0]
-                        end_start = int(line_l[4]) - d_peak_width_by_genes[gene_id][1]
-                        end_end = int(line_l[4]) + d_peak_width_by_genes[gene_id][1]
-                    else:
-                        start_start = int(line_l[2]) - d_peak_width_by_genes[gene_id][1]
-                        start_end = int(line_l[2]) + d_peak_width_by_genes[gene_id][1]
-                        end_start = int(line_l[4]) - d_peak_width_by_genes[gene_id][0]
-                        end_end = int(line_l[4]) + d_peak_width_by_genes[gene_id][0]
+def create_peaks(d_peak_width_by_genes, inf_path, out_dir, points_out_dir=None):
+    '''
+    Reads an isoform file once and writes the isoforms of the genes with peaks as +-width windows
+    and, if points_out_dir is given, as point peaks
+    '''
+    with ExitStack() as stack:
+        ouf = stack.enter_context(IsoformWriter(os.path.join(out_dir, os.path.basename(inf_path))))
+        points_ouf = None
+        if points_out_dir is not None:
+            points_ouf = stack.enter_context(IsoformWriter(os.path.join(points_out_dir, os.path.basename(inf_path))))
 
-                    line_l[2] = f'{start_start}-{start_end}'
-                    line_l[4] = f'{end_start}-{end_end}'
-                ouf.write('\t'.join(line_l) + '\n')
+        for iso in iter_isoforms(inf_path):
+            widths = d_peak_width_by_genes.get(iso.tail[-1])
+            if widths is None:
+                continue
+            ouf.write(iso if iso.is_peak else make_peak_windows(iso, *widths))
+            if points_ouf is not None:
+                points_ouf.write(iso._replace(is_peak=True))
 
 
-def main(peak_width_fpath, inp_dir, out_dir):
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+def main(peak_width_fpath, inp_dir, out_dir, n_jobs=1, points_out_dir=None):
+    for path in (out_dir, points_out_dir):
+        if path is not None and not os.path.exists(path):
+            os.mkdir(path)
     
     d_peak_width_by_genes = read_peak_width(peak_width_fpath)
-    for file in os.listdir(inp_dir):
+    l_tasks = []
+    for file in sorted(os.listdir(inp_dir)):
         inf_path = os.path.join(inp_dir, file)
         if os.path.isfile(inf_path):
-            create_peaks(inf_path, out_dir, d_peak_width_by_genes)
+            l_tasks.append((inf_path, out_dir, points_out_dir))
+    map_with_shared_state(create_peaks, d_peak_width_by_genes, l_tasks, n_jobs)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.peak_width, args.inp_dir, args.out_dir)
+    main(args.peak_width, args.inp_dir, args.out_dir, args.jobs, args.points_out_dir)
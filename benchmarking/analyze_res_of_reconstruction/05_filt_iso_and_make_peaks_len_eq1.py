@@ -1,56 +1,53 @@
 import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.parallel import map_with_shared_state
+from flic_utils.iso_store import iter_isoforms, write_isoforms
+from flic_utils.peaks import read_peak_width
 
 
 def parser_args():
-    parser = argparse.ArgumentParser(description='This script makes peaks for isoforms with length equal to 1')
+    parser = argparse.ArgumentParser(description='This script makes peaks for isoforms with length equal to 1. '
+                                     '05_filt_iso_and_make_peaks.py --points_out_dir writes the same files together with the +-width peaks')
     parser.add_argument('--peak_width', required=True, 
                         help='Path to the file with peak width by genes. Need for filtering isoforms')
     parser.add_argument('--inp_dir', required=True, 
                         help='Path to the input directory containing isoform structures')
     parser.add_argument('--out_dir', required=True, 
                         help='Path to the output directory')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of input files processed in parallel')
 
     return parser.parse_args()
 
 
-def read_peak_width(peak_width_fpath):
-    d_peak_width_by_genes = {}
-    with open(peak_width_fpath) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            gene_id, tss, pa = line.strip('\n').split('\t')
-            d_peak_width_by_genes[gene_id] = (int(round(int(tss) / 2, 0)), int(round(int(pa) / 2, 0)))
-    
-    return d_peak_width_by_genes
+def iter_peaks(d_peak_width_by_genes, inf_path):
+    for iso in iter_isoforms(inf_path):
+        gene_id = iso.tail[-1]
+        if gene_id in d_peak_width_by_genes:
+            yield iso._replace(is_peak=True)
 
 
-def create_peaks(inf_path, out_dir, d_peak_width_by_genes):
+def create_peaks(d_peak_width_by_genes, inf_path, out_dir):
     ouf_path = os.path.join(out_dir, os.path.basename(inf_path))
-
-    with open(inf_path) as inf, open(ouf_path, 'w') as ouf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            gene_id = line_l[-1]
-            if gene_id in d_peak_width_by_genes.keys():
-                if not '-' in line_l[2]:
-                    line_l[2] = f'{line_l[2]}-{line_l[2]}'
-                    line_l[4] = f'{line_l[4]}-{line_l[4]}'
-                ouf.write('\t'.join(line_l) + '\n')
+    write_isoforms(iter_peaks(d_peak_width_by_genes, inf_path), ouf_path)
 
 
-def main(peak_width_fpath, inp_dir, out_dir):
+def main(peak_width_fpath, inp_dir, out_dir, n_jobs=1):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
     
     d_peak_width_by_genes = read_peak_width(peak_width_fpath)
-    for file in os.listdir(inp_dir):
+    l_tasks = []
+    for file in sorted(os.listdir(inp_dir)):
         inf_path = os.path.join(inp_dir, file)
         if os.path.isfile(inf_path):
-            create_peaks(inf_path, out_dir, d_peak_width_by_genes)
+            l_tasks.append((inf_path, out_dir))
+    map_with_shared_state(create_peaks, d_peak_width_by_genes, l_tasks, n_jobs)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.peak_width, args.inp_dir, args.out_dir)
+    main(args.peak_width, args.inp_dir, args.out_dir, args.jobs)
@@ -1,10 +1,15 @@
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.iso_store import iter_isoforms, write_isoforms
 
 
 def parser_args():
     parser = argparse.ArgumentParser(description='This script filters the reference isoforms, leaving only those isoforms for which peaks of TSSs and PAs were found')
     parser.add_argument('--inf_path', required=True, 
-                        help='Path to the input file with reference isoforms structure')
+                        help='Path to the input file with reference isoforms structure (TSV or .npz isoform store)')
     parser.add_argument('--peak_width', required=True, 
                         help='Path to the file with peak width by genes')
     parser.add_argument('--ouf_path', required=True, 
@@ -25,14 +30,8 @@ def get_s_good_genes(peak_width_fpath):
 def filt_ref_iso(inf_path, peak_width_fpath, ouf_path):
     s_good_genes = get_s_good_genes(peak_width_fpath)
 
-    with open(inf_path) as inf, open(ouf_path, 'w') as ouf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            transcript_id = line_l[-1]
-            gene_id = '.'.join(transcript_id.split('.')[:-1])
-
-            if gene_id in s_good_genes:
-                ouf.write(line)
+    write_isoforms((iso for iso in iter_isoforms(inf_path) if '.'.join(iso.tail[-1].split('.')[:-1]) in s_good_genes),
+                   ouf_path)
 
 
 if __name__ == '__main__':
@@ -1,129 +1,503 @@
 import argparse
+import math
 import os
+import sys
+import numpy as np
+
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.iso_store import iter_isoforms
+from flic_utils.junctions import JunctionTable
+from flic_utils.parallel import map_with_shared_state
+from flic_utils.peaks import read_peak_width
+from flic_utils.writers import AtomicWriter
+
+
+# well expressed: >= 1 read in more than one sample and >= DEFAULT_EXPR_THRESHOLD reads in at least one sample
+DEFAULT_EXPR_THRESHOLD = 5
+DEFAULT_EXPR_THRESHOLDS = [1, 2, 5, 10, 20, 50, 100]
+NO_MATCH_LEVEL = np.iinfo(np.int64).max
+# number of sampled gene indices per bootstrap chunk
+BOOTSTRAP_CHUNK_SIZE = 1 << 22
+
+DEFAULT_BP_TOLERANCES = [0, 10, 25, 50, 100, 200]
+DEFAULT_WIDTH_SCALES = [0.5, 1.0, 1.5, 2.0]
+
+# reference isoforms in the argument order of collect_matches and collect_border_distances
+RefIndex = namedtuple('RefIndex', ['d_ref_index', 'd_levels', 'd_gene_levels', 'junctions'])
+ToleranceState = namedtuple('ToleranceState', ['bp_tolerances', 'width_scales', 'd_peak_width_by_genes', 'max_dist'])
+BootstrapState = namedtuple('BootstrapState', ['n_resamples', 'ci_level', 'seed', 'd_gene_n_transcripts', 'd_gene_idx'])
+# bootstrap is None if the confidence intervals are not computed
+RefState = namedtuple('RefState', ['ref_index', 'n_transcripts', 'd_mods', 'thresholds', 'tolerance', 'bootstrap'])
+MatchSummary = namedtuple('MatchSummary', ['gene_min', 'gene_max', 'match_min', 'match_max', 'gene_ids', 'd_credit_lo'])
+BorderDistances = namedtuple('BorderDistances', ['iso_offsets', 'transcript_ids', 'levels', 'start_dists', 'end_dists',
+                                                 'start_widths', 'end_widths', 'gene_min', 'gene_max'])
 
 
 def parser_args():
     parser = argparse.ArgumentParser(description='This script calculates statistics on isoform reconstruction results')
 
     parser.add_argument('--ref_iso', required=True, 
-                        help='Path to the reference isoforms file')
+                        help='Path to the reference isoforms file (TSV or .npz isoform store)')
     parser.add_argument('--sim_transcripts_dir', required=True, 
                         help='Path to the simulated transcripts directory')
     parser.add_argument('--modes_info', required=True, help='Path to transcripts mode information file')
     parser.add_argument('--reconstructed_iso_dir', required=True, 
-                        help='Path to the directory containing reconstructed isoforms')
+                        help='Path to the directory containing reconstructed isoforms (TSV or .npz isoform stores)')
     parser.add_argument('--out_dir', required=True, 
                         help='Path to the output directory for statistics')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of reconstructed isoforms files evaluated in parallel')
+    parser.add_argument('--expr_grid_out_dir', default=None, 
+                        help='Path to the output directory for the metrics over a grid of expression thresholds, '
+                             'one tidy table per reconstructed isoforms file')
+    parser.add_argument('--expr_thresholds', type=int, nargs='+', default=DEFAULT_EXPR_THRESHOLDS, 
+                        help='Minimum read count in at least one sample for a well expressed transcript, '
+                             'one grid row per threshold')
+    parser.add_argument('--tolerance_out_dir', default=None, 
+                        help='Path to the output directory for the metrics over a sweep of TSS/PA tolerances, '
+                             'one tidy table per reconstructed isoforms file. Distances are measured from the reconstructed '
+                             'borders, so the tolerance is added to the windows of peak isoforms: pass point isoforms '
+                             '(e.g. the 05_filt_iso_and_make_peaks_len_eq1.py output) instead of the +-width windows')
+    parser.add_argument('--bp_tolerances', type=int, nargs='+', default=DEFAULT_BP_TOLERANCES, 
+                        help='Maximum TSS and PA distances to the reference isoform, in bp')
+    parser.add_argument('--width_scales', type=float, nargs='+', default=DEFAULT_WIDTH_SCALES, 
+                        help='Maximum TSS and PA distances in units of the half peak widths of the gene, needs --peak_width')
+    parser.add_argument('--peak_width', default=None, 
+                        help='Path to the file with peak width by genes for --width_scales, '
+                             'isoforms of genes without peak widths are skipped as in 05')
+    parser.add_argument('--n_bootstrap', type=int, default=0, 
+                        help='Number of gene level bootstrap resamples, every stat line then gets the bounds '
+                             'of its confidence interval as two more columns')
+    parser.add_argument('--ci_level', type=float, default=0.95, 
+                        help='Confidence level of the bootstrap intervals')
+    parser.add_argument('--seed', type=int, default=None, 
+                        help='Seed of the bootstrap, drawn once and written to every stat file if not given')
 
     return parser.parse_args()
 
 
 def extract_real_transcripts_struct(ref_transcripts_fpath):
     d_ref_transcripts_all = {}
-    with open(ref_transcripts_fpath) as inf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            transcript_id = line_l[-1]
-            d_ref_transcripts_all[transcript_id] = '\t'.join(line_l[:-1])
+    for iso in iter_isoforms(ref_transcripts_fpath):
+        d_ref_transcripts_all[iso.tail[-1]] = iso
 
     return d_ref_transcripts_all
 
 
-def read_simulated_transcripts(inf_path, d_ref_transcripts_all, d_transcripts_cov, idx):
+def read_simulated_transcripts(inf_path, d_ref_transcripts_all, d_transcript_idx):
+    '''
+    Reads of one simulated sample as (transcript indices, counts) arrays, reference transcripts
+    get indices in the order of their first appearance
+    '''
+    idx_l = []
+    count_l = []
     with open(inf_path) as inf:
         for line in inf:
             line_l = line.strip('\n').split('\t')
             transcript_id = line_l[1]
 
-            if transcript_id in d_ref_transcripts_all.keys():
-                transcript_id_w_struct = f'{transcript_id} {d_ref_transcripts_all[transcript_id]}'
-                if transcript_id_w_struct not in d_transcripts_cov.keys():
-                    d_transcripts_cov[transcript_id_w_struct] = [0, 0, 0]
-                d_transcripts_cov[transcript_id_w_struct][idx] += int(line_l[-1])
-    return d_transcripts_cov
-
-
-def split_data_by_expr(d_transcripts_cov):
-    d_good_expr_transcripts = {}
-    d_bad_expr_transcripts = {}
-    for key, val_l in d_transcripts_cov.items():
-        transcript_id, iso_struct = key.split(' ')
-        gene_id = '.'.join(transcript_id.split('.')[:-1])
-
-        if sum([x >= 1 for x in val_l]) > 1 and sum([x >= 5 for x in val_l]) > 0:
-            if gene_id not in d_good_expr_transcripts.keys():
-                d_good_expr_transcripts[gene_id] = []
-            d_good_expr_transcripts[gene_id].append((transcript_id, iso_struct))
-        else:
-            if gene_id not in d_bad_expr_transcripts.keys():
-                d_bad_expr_transcripts[gene_id] = []
-            d_bad_expr_transcripts[gene_id].append((transcript_id, iso_struct))
-
-    return d_good_expr_transcripts, d_bad_expr_transcripts
+            if transcript_id in d_ref_transcripts_all:
+                if transcript_id not in d_transcript_idx:
+                    d_transcript_idx[transcript_id] = len(d_transcript_idx)
+                idx_l.append(d_transcript_idx[transcript_id])
+                count_l.append(int(line_l[-1]))
+    return np.array(idx_l, dtype=np.int64), np.array(count_l, dtype=np.int64)
+
+
+def build_coverage_matrix(l_sample_counts, n_transcripts):
+    '''
+    [(transcript indices, counts) for every sample] -> transcripts x samples count matrix
+    '''
+    cov_matrix = np.zeros((n_transcripts, len(l_sample_counts)), dtype=np.int64)
+    for sample_idx, (idx_arr, count_arr) in enumerate(l_sample_counts):
+        np.add.at(cov_matrix[:, sample_idx], idx_arr, count_arr)
+    return cov_matrix
+
+
+def calc_expr_levels(cov_matrix):
+    '''
+    Expression level of every transcript: the maximum count over the samples if it has >= 1 read in more than
+    one sample, otherwise 0. A transcript is well expressed at threshold t >= 1 if its level is >= t
+    '''
+    is_multi_sample = (cov_matrix >= 1).sum(axis=1) > 1
+    return np.where(is_multi_sample, cov_matrix.max(axis=1, initial=0), 0)
+
+
+def get_gene_id(transcript_id):
+    return '.'.join(transcript_id.split('.')[:-1])
+
+
+def group_by_genes(transcript_ids_l, d_ref_transcripts_all):
+    d_ref_isoforms = {}
+    for transcript_id in transcript_ids_l:
+        gene_id = get_gene_id(transcript_id)
+        if gene_id not in d_ref_isoforms:
+            d_ref_isoforms[gene_id] = []
+        d_ref_isoforms[gene_id].append((transcript_id, d_ref_transcripts_all[transcript_id]))
+    return d_ref_isoforms
+
+
+def index_ref_isoforms(d_ref_isoforms, junctions):
+    '''
+    {gene_id: [(transcript_id, iso), ...]} -> {gene_id: {junction ids: (starts, ends, orders, transcript_ids)}}
+    The intron chains are interned in junctions. Isoforms sharing an intron chain are sorted by start,
+    orders keep the position in the source list
+    '''
+    d_ref_index = {}
+    for gene_id, ref_iso_l in d_ref_isoforms.items():
+        d_by_introns = defaultdict(list)
+        for order, (transcript_id, ref_iso) in enumerate(ref_iso_l):
+            junction_ids = junctions.intern_chain(ref_iso.chrom, ref_iso.strand, ref_iso.introns)
+            d_by_introns[junction_ids].append((ref_iso.start[0], ref_iso.end[0], order, transcript_id))
+
+        d_ref_index[gene_id] = {}
+        for junction_ids, iso_l in d_by_introns.items():
+            iso_l.sort()
+            d_ref_index[gene_id][junction_ids] = tuple(list(column) for column in zip(*iso_l))
+    return d_ref_index
 
 
 def prep_ref_data(ref_iso_fpath, sim_transcripts_path):
+    '''
+    Index of all simulated reference isoforms with {transcript_id: expression level}
+    and {gene_id: (min level, max level)}, {gene_id: number of reference transcripts} and the JunctionTable
+    of the reference introns
+    '''
     d_ref_transcripts_all = extract_real_transcripts_struct(ref_iso_fpath)
 
-    d_transcripts_cov = {}
-    for idx, file in enumerate(os.listdir(sim_transcripts_path)):
-        d_transcripts_cov = read_simulated_transcripts(os.path.join(sim_transcripts_path, file),
-                                                       d_ref_transcripts_all,
-                                                       d_transcripts_cov,
-                                                       idx)
-    ref_pos, ref_neg = split_data_by_expr(d_transcripts_cov)
-    return ref_pos, ref_neg, len(d_ref_transcripts_all)
-
-
-def is_find_ref_iso(s_ref_iso, peak_start, peak_end, reconstructed_splice_sites):
-    for ref_iso_w_id in s_ref_iso:
-        transcript_id, ref_iso = ref_iso_w_id
-        ref_iso_l = ref_iso.split('\t')
-        ref_start = int(ref_iso_l[2])
-        ref_end = int(ref_iso_l[4])
-        ref_splice_sites = ref_iso_l[3]
-        if (reconstructed_splice_sites == ref_splice_sites and
-                peak_start[0] <= ref_start <= peak_start[1] and
-                peak_end[0] <= ref_end <= peak_end[1]):
-            return transcript_id
-    return 'None'
-
-
-def calc_n_matched_iso(reconstructed_iso_fpath, ref_isoforms):
-    s_matches = set()
-    n_mismatches = 0
-    with open(reconstructed_iso_fpath) as inf:
-        for line in inf:
-            *iso_struct, gene_id = line.strip('\n').split('\t')
-            peak_start = tuple(map(int, iso_struct[2].split('-')))
-            peak_end = tuple(map(int, iso_struct[4].split('-')))
-            reconstructed_splice_sites = iso_struct[3]
-
-            if gene_id in ref_isoforms.keys():
-                transcript_id = is_find_ref_iso(ref_isoforms[gene_id], peak_start,
-                                                peak_end, reconstructed_splice_sites)
-                if transcript_id != 'None':
-                    s_matches.add(transcript_id)
-                else:
-                    n_mismatches += 1
-
-    return s_matches, n_mismatches
-
-
-def write_stat(ouf_path, tp, fp, fn, tn):
+    d_transcript_idx = {}
+    l_sample_counts = [read_simulated_transcripts(os.path.join(sim_transcripts_path, file), d_ref_transcripts_all,
+                                                  d_transcript_idx)
+                       for file in os.listdir(sim_transcripts_path)]
+    cov_matrix = build_coverage_matrix(l_sample_counts, len(d_transcript_idx))
+    d_levels = dict(zip(d_transcript_idx, calc_expr_levels(cov_matrix).tolist()))
+
+    d_ref_isoforms = group_by_genes(list(d_transcript_idx), d_ref_transcripts_all)
+    d_gene_levels = {}
+    for gene_id, ref_iso_l in d_ref_isoforms.items():
+        levels_l = [d_levels[transcript_id] for transcript_id, _ in ref_iso_l]
+        d_gene_levels[gene_id] = (min(levels_l), max(levels_l))
+    d_gene_n_transcripts = Counter(get_gene_id(transcript_id) for transcript_id in d_ref_transcripts_all)
+    junctions = JunctionTable()
+    return index_ref_isoforms(d_ref_isoforms, junctions), d_levels, d_gene_levels, d_gene_n_transcripts, junctions
+
+
+def find_ref_isoforms(d_ref_by_introns, peak_start, peak_end, junction_ids, with_borders=False):
+    '''
+    Transcript ids of all reference isoforms matching the reconstructed one, in the reference order.
+    junction_ids is None for a chain with an intron absent from the reference, it matches nothing.
+    with_borders gives (transcript_id, start, end) tuples
+    '''
+    if junction_ids not in d_ref_by_introns:
+        return []
+
+    ref_starts, ref_ends, orders, transcript_ids = d_ref_by_introns[junction_ids]
+    matches_l = []
+    for idx in range(bisect_left(ref_starts, peak_start[0]), bisect_right(ref_starts, peak_start[1])):
+        if peak_end[0] <= ref_ends[idx] <= peak_end[1]:
+            matches_l.append((orders[idx], transcript_ids[idx], ref_starts[idx], ref_ends[idx]))
+    matches_l.sort()
+    if with_borders:
+        return [match[1:] for match in matches_l]
+    return [match[1] for match in matches_l]
+
+
+def collect_matches(reconstructed_iso_fpath, d_ref_index, d_levels, d_gene_levels, junctions):
+    '''
+    One pass over the reconstructed isoforms, every isoform is matched once against all reference isoforms
+    of its gene. At threshold t an isoform is credited to its first match with level >= t, so along
+    the matches every new running maximum of the level is credited for running max < t <= level.
+    Returns MatchSummary: per isoform of a simulated gene the gene and match level ranges and the gene id,
+    {transcript_id: lowest running max it was credited above}
+    '''
+    gene_min_l, gene_max_l, match_min_l, match_max_l, gene_ids_l = [], [], [], [], []
+    d_credit_lo = {}
+    for iso in iter_isoforms(reconstructed_iso_fpath):
+        gene_id = iso.tail[-1]
+        if gene_id not in d_ref_index:
+            continue
+
+        transcript_ids_l = find_ref_isoforms(d_ref_index[gene_id], iso.start, iso.end,
+                                             junctions.find_chain(iso.chrom, iso.strand, iso.introns))
+        levels_l = [d_levels[transcript_id] for transcript_id in transcript_ids_l]
+        gene_min_l.append(d_gene_levels[gene_id][0])
+        gene_max_l.append(d_gene_levels[gene_id][1])
+        match_min_l.append(min(levels_l, default=NO_MATCH_LEVEL))
+        match_max_l.append(max(levels_l, default=0))
+        gene_ids_l.append(gene_id)
+
+        running_max = 0
+        for transcript_id, level in zip(transcript_ids_l, levels_l):
+            if level > running_max:
+                d_credit_lo[transcript_id] = min(d_credit_lo.get(transcript_id, running_max), running_max)
+                running_max = level
+
+    return MatchSummary(*(np.array(values_l, dtype=np.int64)
+                          for values_l in (gene_min_l, gene_max_l, match_min_l, match_max_l)), gene_ids_l, d_credit_lo)
+
+
+def count_at_least(sorted_values, thresholds):
+    return len(sorted_values) - np.searchsorted(sorted_values, thresholds, side='left')
+
+
+def calc_counts_by_thresholds(summary, d_levels, thresholds):
+    '''
+    TP, FP and TN counts for every expression threshold from cumulative counts over the sorted levels.
+    FP: isoforms of genes with a well expressed transcript matching none of them,
+    TN: isoforms of genes with a poorly expressed transcript matching none of them
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.int64)
+    credit_lo = np.sort(np.array(list(summary.d_credit_lo.values()), dtype=np.int64))
+    credit_levels = np.sort(np.array([d_levels[transcript_id] for transcript_id in summary.d_credit_lo],
+                                     dtype=np.int64))
+
+    tp = count_at_least(credit_levels, thresholds) - count_at_least(credit_lo, thresholds)
+    gene_min, gene_max, match_min, match_max = (np.sort(values) for values in summary[:4])
+    fp = count_at_least(gene_max, thresholds) - count_at_least(match_max, thresholds)
+    tn = count_at_least(match_min, thresholds) - count_at_least(gene_min, thresholds)
+    return tp, fp, tn
+
+
+def get_tp_transcripts(summary, d_levels, threshold):
+    return {transcript_id for transcript_id, credit_lo in summary.d_credit_lo.items()
+            if credit_lo < threshold <= d_levels[transcript_id]}
+
+
+def get_border_widths(d_peak_width_by_genes, gene_id, strand):
+    '''
+    (start, end) half peak widths of a gene in the genome orientation, (1, 1) without peak widths
+    '''
+    if d_peak_width_by_genes is None:
+        return 1, 1
+    tss_width, pa_width = d_peak_width_by_genes[gene_id]
+    if strand == '+':
+        return tss_width, pa_width
+    return pa_width, tss_width
+
+
+def collect_border_distances(reconstructed_iso_fpath, d_ref_index, d_levels, d_gene_levels, junctions, max_dist,
+                             d_peak_width_by_genes=None):
+    '''
+    One pass over the reconstructed isoforms recording the start and end distances from the reconstructed borders
+    (points or peak windows, 0 inside a window) to every reference isoform with the same intron chain within max_dist.
+    Candidates of isoform i are iso_offsets[i]:iso_offsets[i + 1] in the reference order.
+    With peak widths, isoforms of genes without them are skipped as in 05_filt_iso_and_make_peaks.py
+    '''
+    gene_min_l, gene_max_l, iso_offsets = [], [], [0]
+    transcript_ids_l, levels_l, start_dists_l, end_dists_l, start_widths_l, end_widths_l = [], [], [], [], [], []
+    for iso in iter_isoforms(reconstructed_iso_fpath):
+        gene_id = iso.tail[-1]
+        if gene_id not in d_ref_index:
+            continue
+        if d_peak_width_by_genes is not None and gene_id not in d_peak_width_by_genes:
+            continue
+
+        candidates_l = find_ref_isoforms(d_ref_index[gene_id], (iso.start[0] - max_dist, iso.start[1] + max_dist),
+                                         (iso.end[0] - max_dist, iso.end[1] + max_dist),
+                                         junctions.find_chain(iso.chrom, iso.strand, iso.introns), with_borders=True)
+        start_width, end_width = get_border_widths(d_peak_width_by_genes, gene_id, iso.strand)
+        for transcript_id, ref_start, ref_end in candidates_l:
+            transcript_ids_l.append(transcript_id)
+            levels_l.append(d_levels[transcript_id])
+            start_dists_l.append(max(iso.start[0] - ref_start, ref_start - iso.start[1], 0))
+            end_dists_l.append(max(iso.end[0] - ref_end, ref_end - iso.end[1], 0))
+            start_widths_l.append(start_width)
+            end_widths_l.append(end_width)
+        iso_offsets.append(len(transcript_ids_l))
+        gene_min_l.append(d_gene_levels[gene_id][0])
+        gene_max_l.append(d_gene_levels[gene_id][1])
+
+    return BorderDistances(iso_offsets=iso_offsets, transcript_ids=transcript_ids_l,
+                           levels=np.array(levels_l, dtype=np.int64),
+                           start_dists=np.array(start_dists_l, dtype=np.int64),
+                           end_dists=np.array(end_dists_l, dtype=np.int64),
+                           start_widths=np.array(start_widths_l, dtype=np.int64),
+                           end_widths=np.array(end_widths_l, dtype=np.int64),
+                           gene_min=np.array(gene_min_l, dtype=np.int64), gene_max=np.array(gene_max_l, dtype=np.int64))
+
+
+def scale_dists(dists, widths):
+    '''
+    Distances in units of the peak width, a zero width only allows a zero distance
+    '''
+    scaled = np.where(dists == 0, 0., np.inf)
+    np.divide(dists, widths, out=scaled, where=widths > 0)
+    return scaled
+
+
+def calc_counts_by_tolerances(distances, required, tolerances, expr_threshold):
+    '''
+    TP, FP and TN counts for every tolerance, a candidate matches at tolerance t if required <= t.
+    At tolerance t an isoform is credited to its first well expressed match, so along the candidates every
+    new running minimum of required is credited for required <= t < previous running minimum
+    '''
+    tolerances = np.asarray(tolerances, dtype=float)
+    is_pos = distances.levels >= expr_threshold
+    min_pos_l, min_neg_l = [], []
+    credit_idx_l, credit_lo_l, credit_hi_l = [], [], []
+    d_transcript_idx = {}
+
+    required_l = required.tolist()
+    is_pos_l = is_pos.tolist()
+    offsets = distances.iso_offsets
+    for iso_idx in range(len(offsets) - 1):
+        running_min = np.inf
+        min_neg = np.inf
+        for idx in range(offsets[iso_idx], offsets[iso_idx + 1]):
+            if not is_pos_l[idx]:
+                min_neg = min(min_neg, required_l[idx])
+            elif required_l[idx] < running_min:
+                transcript_id = distances.transcript_ids[idx]
+                credit_idx_l.append(d_transcript_idx.setdefault(transcript_id, len(d_transcript_idx)))
+                credit_lo_l.append(required_l[idx])
+                credit_hi_l.append(running_min)
+                running_min = required_l[idx]
+        min_pos_l.append(running_min)
+        min_neg_l.append(min_neg)
+
+    min_pos = np.array(min_pos_l, dtype=float)
+    min_neg = np.array(min_neg_l, dtype=float)
+    credit_idx = np.array(credit_idx_l, dtype=np.int64)
+    credit_lo = np.array(credit_lo_l, dtype=float)
+    credit_hi = np.array(credit_hi_l, dtype=float)
+    has_pos = distances.gene_max >= expr_threshold
+    has_neg = distances.gene_min < expr_threshold
+
+    tp = np.array([np.unique(credit_idx[(credit_lo <= tolerance) & (tolerance < credit_hi)]).size
+                   for tolerance in tolerances.tolist()], dtype=np.int64)
+    fp = ((min_pos[has_pos][:, None] > tolerances[None, :]).sum(axis=0)).astype(np.int64)
+    tn = ((min_neg[has_neg][:, None] > tolerances[None, :]).sum(axis=0)).astype(np.int64)
+    return tp, fp, tn
+
+
+def evaluate_tolerances(distances, bp_tolerances, width_scales, expr_threshold):
+    '''
+    Counts for fixed tolerances in bp and, with peak widths, for tolerances scaled by the peak width of the gene
+    '''
+    params_l = [('bp', tolerance) for tolerance in bp_tolerances]
+    required = np.maximum(distances.start_dists, distances.end_dists).astype(float)
+    counts_l = [calc_counts_by_tolerances(distances, required, bp_tolerances, expr_threshold)]
+
+    if width_scales:
+        params_l.extend(('width_scale', scale) for scale in width_scales)
+        required = np.maximum(scale_dists(distances.start_dists, distances.start_widths),
+                              scale_dists(distances.end_dists, distances.end_widths))
+        counts_l.append(calc_counts_by_tolerances(distances, required, width_scales, expr_threshold))
+
+    return (params_l, *(np.concatenate(counts) for counts in zip(*counts_l)))
+
+
+def get_modes_l(d_mods):
+    '''
+    Modes in the order of the stat by modes: the seven default ones, then the others in the order of appearance
+    '''
+    return list(dict.fromkeys([str(mode) for mode in range(0, 7)] + list(d_mods.values())))
+
+
+def calc_gene_counts(summary, tp, d_gene_idx, d_gene_n_transcripts, d_mods, modes_l, threshold):
+    '''
+    Genes x [TP, FP, FN, TN, TP of every mode] count matrix, the rows follow d_gene_idx
+    '''
+    d_mode_idx = {mode: idx for idx, mode in enumerate(modes_l)}
+    gene_counts = np.zeros((len(d_gene_idx), 4 + len(modes_l)), dtype=np.int64)
+
+    tp_l = list(tp)
+    tp_gene_idx = np.array([d_gene_idx[get_gene_id(transcript_id)] for transcript_id in tp_l], dtype=np.int64)
+    np.add.at(gene_counts[:, 0], tp_gene_idx, 1)
+    iso_gene_idx = np.array([d_gene_idx[gene_id] for gene_id in summary.gene_ids], dtype=np.int64)
+    is_fp = (summary.gene_max >= threshold) & (summary.match_max < threshold)
+    is_tn = (summary.gene_min < threshold) & (summary.match_min >= threshold)
+    np.add.at(gene_counts[:, 1], iso_gene_idx[is_fp], 1)
+    np.add.at(gene_counts[:, 3], iso_gene_idx[is_tn], 1)
+    gene_counts[:, 2] = np.array([d_gene_n_transcripts[gene_id] for gene_id in d_gene_idx], dtype=np.int64)
+    gene_counts[:, 2] -= gene_counts[:, 0]
+
+    mode_idx = np.array([4 + d_mode_idx[d_mods[transcript_id]] if transcript_id in d_mods else -1
+                         for transcript_id in tp_l], dtype=np.int64)
+    np.add.at(gene_counts, (tp_gene_idx[mode_idx >= 0], mode_idx[mode_idx >= 0]), 1)
+    return gene_counts
+
+
+def bootstrap_gene_counts(gene_counts, n_resamples, rng, chunk_size=BOOTSTRAP_CHUNK_SIZE):
+    '''
+    Resamples x counts sums over the genes drawn with replacement. The index arrays of a chunk of resamples
+    are turned into gene multiplicities with bincount, so the sums are one matrix product
+    '''
+    n_genes = len(gene_counts)
+    sums = np.zeros((n_resamples, gene_counts.shape[1]), dtype=np.int64)
+    if n_genes == 0:
+        return sums
+
+    counts = gene_counts.astype(float)
+    n_chunk = max(1, chunk_size // n_genes)
+    for first in range(0, n_resamples, n_chunk):
+        n_cur = min(n_chunk, n_resamples - first)
+        gene_idx = rng.integers(0, n_genes, size=(n_cur, n_genes))
+        gene_idx += np.arange(n_cur)[:, None] * n_genes
+        weights = np.bincount(gene_idx.ravel(), minlength=n_cur * n_genes).reshape(n_cur, n_genes)
+        sums[first:first + n_cur] = np.rint(weights @ counts).astype(np.int64)
+    return sums
+
+
+def calc_metrics(tp, fp, fn):
+    '''
+    Precision, recall and F1 of count arrays, NaN where undefined
+    '''
+    tp, fp, fn = (np.asarray(values, dtype=float) for values in (tp, fp, fn))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        f1_score = 2 * tp / (2 * tp + fp + fn)
+    return precision, recall, f1_score
+
+
+def calc_percentile_ci(values, ci_level):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan, np.nan
+    tail = (1 - ci_level) / 2 * 100
+    return tuple(np.percentile(values, [tail, 100 - tail]).tolist())
+
+
+def calc_bootstrap_cis(gene_counts, modes_l, n_resamples, ci_level, rng):
+    '''
+    {stat name: (low, high)} percentile intervals of the gene level bootstrap for the metrics and the counts,
+    {mode: (low, high)} for the TP by modes
+    '''
+    sums = bootstrap_gene_counts(gene_counts, n_resamples, rng).astype(float)
+    d_values = dict(zip(['Precision', 'Recall', 'f1-score'], calc_metrics(sums[:, 0], sums[:, 1], sums[:, 2])))
+    d_values.update(zip(['TP', 'FP', 'FN', 'TN'], sums[:, :4].T))
+
+    d_ci = {name: calc_percentile_ci(values, ci_level) for name, values in d_values.items()}
+    d_mode_ci = {mode: calc_percentile_ci(sums[:, 4 + idx], ci_level) for idx, mode in enumerate(modes_l)}
+    return d_ci, d_mode_ci
+
+
+def format_ci(d_ci, name, fmt):
+    if d_ci is None:
+        return ''
+    return ''.join(f'\t{value:{fmt}}' for value in d_ci[name])
+
+
+def write_stat(ouf, tp, fp, fn, tn, d_ci=None):
+    '''
+    With d_ci every line gets the low and high bounds of its confidence interval
+    '''
     precision = len(tp) / (len(tp) + fp)
     recall = len(tp) / (len(tp) + fn)
     f1_score = 2 * precision * recall / (precision + recall)
 
-    with open(ouf_path, 'w') as ouf:
-        ouf.write(f'Precision\t{precision:.4f}\n')
-        ouf.write(f'Recall\t{recall:.4f}\n')
-        ouf.write(f'f1-score\t{f1_score:.4f}\n')
+    ouf.write(f'Precision\t{precision:.4f}{format_ci(d_ci, "Precision", ".4f")}\n')
+    ouf.write(f'Recall\t{recall:.4f}{format_ci(d_ci, "Recall", ".4f")}\n')
+    ouf.write(f'f1-score\t{f1_score:.4f}{format_ci(d_ci, "f1-score", ".4f")}\n')
 
-        ouf.write(f'TP\t{len(tp)}\n')
-        ouf.write(f'FP\t{fp}\n')
-        ouf.write(f'FN\t{fn}\n')
-        ouf.write(f'TN\t{tn}\n')
+    ouf.write(f'TP\t{len(tp)}{format_ci(d_ci, "TP", ".1f")}\n')
+    ouf.write(f'FP\t{fp}{format_ci(d_ci, "FP", ".1f")}\n')
+    ouf.write(f'FN\t{fn}{format_ci(d_ci, "FN", ".1f")}\n')
+    ouf.write(f'TN\t{tn}{format_ci(d_ci, "TN", ".1f")}\n')
 
 
 def read_mod_info(mod_info_file):
@@ -135,33 +509,128 @@ def read_mod_info(mod_info_file):
     return d_mods
 
 
-def write_tp_by_modes(mod_info_file, tp, ouf_path):
-    d_preds_split_by_modes = dict.fromkeys(list(map(str, range(0, 7))), 0)
-    d_mods = read_mod_info(mod_info_file)
-    for elem in tp:
-        if elem in d_mods.keys():
-            d_preds_split_by_modes[d_mods[elem]] += 1
+def format_ratio(numerator, denominator):
+    if denominator == 0:
+        return 'NA'
+    return f'{numerator / denominator:.4f}'
+
+
+def write_metrics_grid(ouf_path, tool, param_names, params_l, tp, fp, tn, n_transcripts):
+    '''
+    Tidy table with one row per parameter combination
+    '''
+    with AtomicWriter(ouf_path) as ouf:
+        ouf.write('\t'.join(['#tool', *param_names, 'Precision', 'Recall', 'f1-score', 'TP', 'FP', 'FN', 'TN']) + '\n')
+        for params, n_tp, n_fp, n_tn in zip(params_l, tp.tolist(), fp.tolist(), tn.tolist()):
+            n_fn = n_transcripts - n_tp
+            params_str = '\t'.join(map(str, params))
+            ouf.write(f'{tool}\t{params_str}\t{format_ratio(n_tp, n_tp + n_fp)}\t{format_ratio(n_tp, n_tp + n_fn)}\t'
+                      f'{format_ratio(2 * n_tp, 2 * n_tp + n_fp + n_fn)}\t{n_tp}\t{n_fp}\t{n_fn}\t{n_tn}\n')
 
-    with open(ouf_path, 'a') as ouf:
-        ouf.write('Stat by modes:\n')
-        for key, val in d_preds_split_by_modes.items():
-            ouf.write(f'{key}\t{val}\n')
 
+def write_tp_by_modes(d_mods, tp, ouf, d_mode_ci=None):
+    d_preds_split_by_modes = dict.fromkeys(get_modes_l(d_mods), 0)
+    for elem in tp:
+        if elem in d_mods:
+            d_preds_split_by_modes[d_mods[elem]] += 1
 
-def main(ref_iso_fpath, sim_transcripts_path, reconstructed_iso_fpath, out_dir, mod_info_file):
-    ouf_path = os.path.join(out_dir, os.path.basename(reconstructed_iso_fpath))
-    ref_pos, ref_neg, n_transcripts = prep_ref_data(ref_iso_fpath, sim_transcripts_path)
-    tp, fp = calc_n_matched_iso(reconstructed_iso_fpath, ref_pos)
-    _, tn = calc_n_matched_iso(reconstructed_iso_fpath, ref_neg)
-    fn = n_transcripts - len(tp)
-    write_stat(ouf_path, tp, fp, fn, tn)
-    write_tp_by_modes(mod_info_file, tp, ouf_path)
+    ouf.write('Stat by modes:\n')
+    for key, val in d_preds_split_by_modes.items():
+        ouf.write(f'{key}\t{val}{format_ci(d_mode_ci, key, ".1f")}\n')
+
+
+def evaluate_reconstructed_iso(ref_state, reconstructed_iso_fpath, out_dir, expr_grid_out_dir=None,
+                               tolerance_out_dir=None):
+    tool = os.path.splitext(os.path.basename(reconstructed_iso_fpath))[0]
+    ouf_name = f'{tool}.tsv'
+    ouf_path = os.path.join(out_dir, ouf_name)
+    ref_index = ref_state.ref_index
+    summary = collect_matches(reconstructed_iso_fpath, *ref_index)
+
+    (_,), (fp,), (tn,) = calc_counts_by_thresholds(summary, ref_index.d_levels, [DEFAULT_EXPR_THRESHOLD])
+    tp = get_tp_transcripts(summary, ref_index.d_levels, DEFAULT_EXPR_THRESHOLD)
+    fn = ref_state.n_transcripts - len(tp)
+
+    d_ci, d_mode_ci = None, None
+    bootstrap = ref_state.bootstrap
+    if bootstrap is not None:
+        modes_l = get_modes_l(ref_state.d_mods)
+        gene_counts = calc_gene_counts(summary, tp, bootstrap.d_gene_idx, bootstrap.d_gene_n_transcripts,
+                                       ref_state.d_mods, modes_l, DEFAULT_EXPR_THRESHOLD)
+        d_ci, d_mode_ci = calc_bootstrap_cis(gene_counts, modes_l, bootstrap.n_resamples, bootstrap.ci_level,
+                                             np.random.default_rng(bootstrap.seed))
+
+    with AtomicWriter(ouf_path) as ouf:
+        write_stat(ouf, tp, int(fp), fn, int(tn), d_ci)
+        write_tp_by_modes(ref_state.d_mods, tp, ouf, d_mode_ci)
+        if bootstrap is not None:
+            ouf.write(f'Bootstrap seed\t{bootstrap.seed}\n')
+
+    if expr_grid_out_dir is not None:
+        counts = calc_counts_by_thresholds(summary, ref_index.d_levels, ref_state.thresholds)
+        write_metrics_grid(os.path.join(expr_grid_out_dir, ouf_name), tool,
+                           ['expr_threshold'], [(threshold,) for threshold in ref_state.thresholds], *counts,
+                           ref_state.n_transcripts)
+
+    if tolerance_out_dir is not None:
+        tolerance = ref_state.tolerance
+        distances = collect_border_distances(reconstructed_iso_fpath, *ref_index, tolerance.max_dist,
+                                             tolerance.d_peak_width_by_genes)
+        width_scales = tolerance.width_scales if tolerance.d_peak_width_by_genes is not None else []
+        params_l, *counts = evaluate_tolerances(distances, tolerance.bp_tolerances, width_scales,
+                                                DEFAULT_EXPR_THRESHOLD)
+        write_metrics_grid(os.path.join(tolerance_out_dir, ouf_name), tool,
+                           ['tolerance_type', 'tolerance'], params_l, *counts, ref_state.n_transcripts)
+
+
+def main(ref_iso_fpath, sim_transcripts_path, reconstructed_iso_dir, out_dir, mod_info_file, n_jobs=1,
+         expr_grid_out_dir=None, thresholds=DEFAULT_EXPR_THRESHOLDS, tolerance_out_dir=None,
+         bp_tolerances=DEFAULT_BP_TOLERANCES, width_scales=DEFAULT_WIDTH_SCALES, peak_width_fpath=None, n_bootstrap=0,
+         ci_level=0.95, seed=None):
+    '''
+    Every reconstructed isoforms file is bootstrapped with the same seed, so the tools are compared
+    on the same gene resamples. Without a seed one is drawn here and written as the last line
+    of the stat files, so the intervals can be reproduced
+    '''
+    if min(thresholds) < 1:
+        raise ValueError(f'Expression thresholds must be >= 1: {thresholds}')
+    if min(bp_tolerances + width_scales) < 0:
+        raise ValueError(f'Tolerances must be >= 0: {bp_tolerances} {width_scales}')
+    if not 0 < ci_level < 1:
+        raise ValueError(f'Confidence level must be between 0 and 1: {ci_level}')
+    for path in (expr_grid_out_dir, tolerance_out_dir):
+        if path is not None and not os.path.exists(path):
+            os.mkdir(path)
+
+    d_ref_index, d_levels, d_gene_levels, d_gene_n_transcripts, junctions = prep_ref_data(ref_iso_fpath,
+                                                                                          sim_transcripts_path)
+    d_peak_width_by_genes = None if peak_width_fpath is None else read_peak_width(peak_width_fpath)
+    max_dist = max(bp_tolerances)
+    if d_peak_width_by_genes:
+        max_width = max(max(widths) for widths in d_peak_width_by_genes.values())
+        max_dist = max(max_dist, math.ceil(max(width_scales) * max_width))
+    tolerance = ToleranceState(sorted(bp_tolerances), sorted(width_scales), d_peak_width_by_genes, max_dist)
+    bootstrap = None
+    if n_bootstrap > 0:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        d_gene_idx = {gene_id: idx for idx, gene_id in enumerate(d_gene_n_transcripts)}
+        bootstrap = BootstrapState(n_bootstrap, ci_level, seed, d_gene_n_transcripts, d_gene_idx)
+    ref_state = RefState(RefIndex(d_ref_index, d_levels, d_gene_levels, junctions),
+                         sum(d_gene_n_transcripts.values()), read_mod_info(mod_info_file), sorted(thresholds),
+                         tolerance, bootstrap)
+
+    l_tasks = []
+    for file in sorted(os.listdir(reconstructed_iso_dir)):
+        reconstructed_iso_fpath = os.path.join(reconstructed_iso_dir, file)
+        if os.path.isfile(reconstructed_iso_fpath):
+            l_tasks.append((reconstructed_iso_fpath, out_dir, expr_grid_out_dir, tolerance_out_dir))
+
+    map_with_shared_state(evaluate_reconstructed_iso, ref_state, l_tasks, n_jobs)
 
 
 if __name__ == '__main__':
     args = parser_args()
-
-    for file in os.listdir(args.reconstructed_iso_dir):
-        if os.path.isfile(os.path.join(args.reconstructed_iso_dir, file)):
-            reconstructed_iso_fpath = os.path.join(args.reconstructed_iso_dir, file)
-            main(args.ref_iso, args.sim_transcripts_dir, reconstructed_iso_fpath, args.out_dir, args.modes_info)
+    main(args.ref_iso, args.sim_transcripts_dir, args.reconstructed_iso_dir, args.out_dir, args.modes_info, args.jobs,
+         args.expr_grid_out_dir, args.expr_thresholds, args.tolerance_out_dir, args.bp_tolerances, args.width_scales,
+         args.peak_width, args.n_bootstrap, args.ci_level, args.seed)
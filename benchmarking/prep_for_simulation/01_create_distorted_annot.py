@@ -1,6 +1,24 @@
 import argparse
-import re
-import random
+import os
+import sys
+import numpy as np
+
+from collections import namedtuple
+from contextlib import ExitStack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.distortion import (DEFAULT_SPEC, correct_exons_borders_batch, draw_transcript_shifts,
+                                   load_distortion_specs, modify_transcripts_batch)
+from flic_utils.gtf_parser import iter_gtf, parse_attributes
+from flic_utils.parallel import map_with_shared_state
+from flic_utils.writers import AtomicWriter
+
+
+CHUNK_N_TRANSCRIPTS = 1 << 14
+
+AnnotChunk = namedtuple('AnnotChunk', ['gene_lines', 'gene_offsets', 'transcript_ids', 'transcript_lines',
+                                       'starts', 'stops', 'is_plus', 'exon_lines', 'exon_starts', 'exon_ends',
+                                       'exon_offsets'])
 
 
 def parser_args():
@@ -11,160 +29,221 @@ def parser_args():
                         help='Path to the source transcripts mode file')
     parser.add_argument('--ouf_path', required=True, 
                         help='Path to the output distorted annotation file')
+    parser.add_argument('--fixed_modes_ouf_path', default=None, 
+                        help='Path to the fixed transcripts mode file: transcripts with unchanged borders get mode 0, '
+                             'the same file as 02_fix_transcript_modes_file.py makes from the two annotations')
+    parser.add_argument('--n_replicates', type=int, default=1, 
+                        help='Number of distorted annotations, replicate i is written to <name>.rep<i><ext> '
+                             'next to --ouf_path and --transcript_modes_ouf_path')
+    parser.add_argument('--seed', type=int, default=None, 
+                        help='Seed of the simulation, every replicate gets its own random stream derived from it')
+    parser.add_argument('--distortion_spec', default=None, 
+                        help='Path to a JSON distortion spec (see flic_utils.distortion.load_distortion_specs), '
+                             'the seven +-100 bp modes by default. With several specs every spec is written '
+                             'to <name>.<spec name><ext> next to the output paths')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of distorted annotations written in parallel')
 
     return parser.parse_args()
 
 
-def create_bins_for_transcripts(inf_path, ouf_path):
+def iter_gene_blocks(inf_path):
     '''
-    0 - control
-    1 - 5' shorter
-    2 - 3' shorter
-    3 - 5' longer
-    4 - 3' longer
-    5 - 5' and 3' shorter
-    6 - 5' and 3' longer
+    Streams the annotation by gene: every block is (gene_line_l, [(transcript_id, transcript_line_l, exons_l), ...])
+    for consecutive gene, transcript and exon lines with the same gene_id, gene_line_l is None
+    for annotations without gene lines. Other features are skipped
     '''
-    d_transcripts_mode = {}
-
-    with open(inf_path) as inf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            if feat_type == 'transcript':
-                transcript_id = re.findall(r'transcript_id "(.+?)"', line_l[8])[0]
-                d_transcripts_mode[transcript_id] = random.randint(0, 6)
-    
-    with open(ouf_path, 'w') as ouf:
-        for transcript_id in d_transcripts_mode:
-            mode = str(d_transcripts_mode[transcript_id])
-            ouf.write(f'{transcript_id}\t{mode}\n')
-
-    return d_transcripts_mode
-
-
-def modify_transcripts(start, stop, orientation, type_mod):
-    modifications_by_groups = {0: (0, 0), 1: (100, 0), 2: (0, -100), 3: (-100, 0), 
-                               4: (0, 100), 5: (100, -100), 6: (-100, 100)}
-    
-    start_add, stop_add = modifications_by_groups[type_mod]
-    if orientation == '+':
-        start_mod = start + start_add
-        stop_mod = stop + stop_add
-    else:
-        start_mod = start - stop_add
-        stop_mod = stop - start_add
-    
-    if stop_mod - start_mod > 0:
-        return start_mod, stop_mod
-    else:
-        return start, stop
-    
-    
-def modify_exons(transcript_borders, exon_start, exon_end):
-    transcript_start, transcript_end = transcript_borders
-    if abs(transcript_start - exon_start) == 100:
-        exon_start = transcript_start
-    if abs(transcript_end - exon_end) == 100:
-        exon_end = transcript_end
-    
-    return exon_start, exon_end
-
-
-def change_borders_r1(inf_path, d_transcripts_mode):
-    d_new_genes_coords = {}
-    d_new_transcript_coords = {}
+    gene_id = None
+    gene_line_l = None
+    transcripts_l = []
     d_exons = {}
 
-    with open(inf_path) as inf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            orientation = line_l[6]
-            start = int(line_l[3])
-            stop = int(line_l[4])
-
-            if feat_type == 'transcript':
-                gene_id = re.findall(r'gene_id "(.+?)"', line_l[8])[0]
-                if gene_id not in d_new_genes_coords.keys():
-                    d_new_genes_coords[gene_id] = [float('inf'), float('-inf')]
-
-                transcript_id = re.findall(r'transcript_id "(.+?)"', line_l[8])[0]
-                start, stop = modify_transcripts(start, stop, orientation, 
-                                                          d_transcripts_mode[transcript_id])
-                d_new_transcript_coords[transcript_id] = [start, stop]
-
-                d_new_genes_coords[gene_id][0] = min(d_new_genes_coords[gene_id][0], start)
-                d_new_genes_coords[gene_id][1] = max(d_new_genes_coords[gene_id][1], stop)
-
-                d_exons[transcript_id] = []
-
-            elif feat_type == 'exon':
-                transcript_id = re.findall(r'transcript_id "(.+?)"', line_l[8])[0]
-                d_exons[transcript_id].append(line_l)
-    
-    d_exons = {k: sorted(v, key=lambda x: x[3]) for k, v in d_exons.items()}
-    return d_new_genes_coords, d_new_transcript_coords, d_exons
-
-
-def correct_exons_borders(exons_l, start_transcript, stop_transcript):
-    is_find_cor_start = False
-    is_find_cor_stop = True
-    new_exons_l = []
-
-    for cur_exon in exons_l:
-        if int(cur_exon[4]) > start_transcript and int(cur_exon[3]) < stop_transcript:
-            new_exons_l.append(cur_exon)
-    
-    if new_exons_l == []:
-        new_exons_l.append(cur_exon)
-    
-    new_exons_l.sort(key=lambda x: int(x[3]))
-    new_exons_l[0][3] = start_transcript
-    new_exons_l[-1][4] = stop_transcript
-    return new_exons_l
-
-
-def get_correct_d_exons(d_exons, d_new_transcript_coords):
-    d_corr_exons = {}
-    for transcript, exons_l in d_exons.items():
-        start_transcript, stop_transcript = d_new_transcript_coords[transcript]
-        d_corr_exons[transcript] = correct_exons_borders(exons_l, start_transcript, stop_transcript)
-    
-    return d_corr_exons
-
-
-def write_final_res(inf_path, ouf_path, d_new_genes_coords, d_new_transcript_coords, d_corr_exons):
-    with open(inf_path) as inf, open(ouf_path, 'w') as ouf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            if feat_type == 'gene':
-                gene_id = re.findall(r'gene_id "(.+?)"', line_l[8])[0]
-                line_l[3] = str(d_new_genes_coords[gene_id][0])
-                line_l[4] = str(d_new_genes_coords[gene_id][1])
-
-                with open(ouf_path, 'a') as ouf:
-                    ouf.write('\t'.join(line_l) + '\n')
-            elif feat_type == 'transcript':
-                transcript_id = re.findall(r'transcript_id "(.+?)"', line_l[8])[0]
-                line_l[3] = str(d_new_transcript_coords[transcript_id][0])
-                line_l[4] = str(d_new_transcript_coords[transcript_id][1])
-
-                exons_l = d_corr_exons[transcript_id]
-                with open(ouf_path, 'a') as ouf:
-                    ouf.write('\t'.join(line_l) + '\n')
-                    for cur_exon in exons_l:
-                        ouf.write('\t'.join(list(map(str, cur_exon))) + '\n')
-
-
-def main(inf_path, transcript_modes, ouf_path):
-    d_transcripts_mode = create_bins_for_transcripts(inf_path, transcript_modes)
-    d_new_genes_coords, d_new_transcript_coords, d_exons = change_borders_r1(inf_path, d_transcripts_mode)
-    d_corr_exons = get_correct_d_exons(d_exons, d_new_transcript_coords)
-    write_final_res(inf_path, ouf_path, d_new_genes_coords, d_new_transcript_coords, d_corr_exons)
+    for line_l in iter_gtf(inf_path):
+        feat_type = line_l[2]
+        if feat_type not in ('gene', 'transcript', 'exon'):
+            continue
+
+        attrs = parse_attributes(line_l[8])
+        if feat_type == 'gene' or attrs['gene_id'] != gene_id:
+            if gene_id is not None:
+                yield gene_line_l, transcripts_l
+            gene_id = attrs['gene_id']
+            gene_line_l = None
+            transcripts_l = []
+            d_exons = {}
+
+        if feat_type == 'gene':
+            gene_line_l = line_l
+        elif feat_type == 'transcript':
+            transcript_id = attrs['transcript_id']
+            d_exons[transcript_id] = []
+            transcripts_l.append((transcript_id, line_l, d_exons[transcript_id]))
+        else:
+            d_exons[attrs['transcript_id']].append(line_l)
+
+    if gene_id is not None:
+        yield gene_line_l, transcripts_l
+
+
+def split_gtf_line(line_l):
+    '''
+    GTF line around its coordinates: (first three columns, columns after the end)
+    '''
+    return '\t'.join(line_l[:3]), '\t'.join(line_l[5:])
+
+
+def build_annot_chunk(gene_blocks):
+    '''
+    Flat arrays of transcript and exon borders for a list of gene blocks, the exons of every transcript
+    are kept in the order of their start column sorted as strings
+    '''
+    gene_lines, gene_offsets = [], [0]
+    transcript_ids, transcript_lines, starts, stops, is_plus = [], [], [], [], []
+    exon_lines, exon_starts, exon_ends, exon_offsets = [], [], [], [0]
+
+    for gene_line_l, transcripts_l in gene_blocks:
+        if gene_line_l is None:
+            gene_lines.append(None)
+        else:
+            gene_lines.append((*split_gtf_line(gene_line_l), gene_line_l[3], gene_line_l[4]))
+
+        for transcript_id, line_l, exons_l in transcripts_l:
+            transcript_ids.append(transcript_id)
+            transcript_lines.append(split_gtf_line(line_l))
+            starts.append(int(line_l[3]))
+            stops.append(int(line_l[4]))
+            is_plus.append(line_l[6] == '+')
+
+            for exon_l in sorted(exons_l, key=lambda x: x[3]):
+                exon_lines.append(split_gtf_line(exon_l))
+                exon_starts.append(int(exon_l[3]))
+                exon_ends.append(int(exon_l[4]))
+            exon_offsets.append(len(exon_starts))
+        gene_offsets.append(len(transcript_ids))
+
+    return AnnotChunk(gene_lines=gene_lines, gene_offsets=np.array(gene_offsets, dtype=np.int64),
+                      transcript_ids=transcript_ids, transcript_lines=transcript_lines,
+                      starts=np.array(starts, dtype=np.int64), stops=np.array(stops, dtype=np.int64),
+                      is_plus=np.array(is_plus, dtype=bool), exon_lines=exon_lines,
+                      exon_starts=np.array(exon_starts, dtype=np.int64), exon_ends=np.array(exon_ends, dtype=np.int64),
+                      exon_offsets=np.array(exon_offsets, dtype=np.int64))
+
+
+def iter_annot_chunks(gene_blocks, chunk_size=CHUNK_N_TRANSCRIPTS):
+    '''
+    Groups whole gene blocks into chunks of about chunk_size transcripts
+    '''
+    l_blocks = []
+    n_transcripts = 0
+    for gene_block in gene_blocks:
+        l_blocks.append(gene_block)
+        n_transcripts += len(gene_block[1])
+        if n_transcripts >= chunk_size:
+            yield build_annot_chunk(l_blocks)
+            l_blocks = []
+            n_transcripts = 0
+
+    if l_blocks:
+        yield build_annot_chunk(l_blocks)
+
+
+def calc_gene_borders(gene_offsets, starts, stops):
+    has_transcripts = np.diff(gene_offsets) > 0
+    gene_starts = np.zeros(len(has_transcripts), dtype=np.int64)
+    gene_stops = np.zeros(len(has_transcripts), dtype=np.int64)
+    if has_transcripts.any():
+        first_transcripts = gene_offsets[:-1][has_transcripts]
+        gene_starts[has_transcripts] = np.minimum.reduceat(starts, first_transcripts)
+        gene_stops[has_transcripts] = np.maximum.reduceat(stops, first_transcripts)
+    return gene_starts, gene_stops, has_transcripts
+
+
+def write_distorted_chunk(chunk, spec, rng, modes_ouf, ouf, fixed_modes_ouf=None):
+    modes, start_add, stop_add = draw_transcript_shifts(spec, len(chunk.transcript_ids), rng)
+    starts, stops, _ = modify_transcripts_batch(chunk.starts, chunk.stops, chunk.is_plus, start_add, stop_add)
+    kept_idx, exon_starts, exon_ends, kept_offsets = correct_exons_borders_batch(chunk.exon_starts, chunk.exon_ends,
+                                                                                chunk.exon_offsets, starts, stops)
+    gene_starts, gene_stops, has_transcripts = calc_gene_borders(chunk.gene_offsets, starts, stops)
+
+    for transcript_id, mode in zip(chunk.transcript_ids, modes.tolist()):
+        modes_ouf.write(f'{transcript_id}\t{mode}\n')
+    if fixed_modes_ouf is not None:
+        fixed_modes = np.where((starts == chunk.starts) & (stops == chunk.stops), 0, modes)
+        for transcript_id, mode in zip(chunk.transcript_ids, fixed_modes.tolist()):
+            fixed_modes_ouf.write(f'{transcript_id}\t{mode}\n')
+
+    gene_offsets = chunk.gene_offsets.tolist()
+    starts, stops = starts.tolist(), stops.tolist()
+    kept_idx, kept_offsets = kept_idx.tolist(), kept_offsets.tolist()
+    exon_starts, exon_ends = exon_starts.tolist(), exon_ends.tolist()
+    gene_starts, gene_stops, has_transcripts = gene_starts.tolist(), gene_stops.tolist(), has_transcripts.tolist()
+
+    for gene_idx, gene_line in enumerate(chunk.gene_lines):
+        if gene_line is not None:
+            head, tail, gene_start, gene_stop = gene_line
+            if has_transcripts[gene_idx]:
+                gene_start, gene_stop = gene_starts[gene_idx], gene_stops[gene_idx]
+            ouf.write(f'{head}\t{gene_start}\t{gene_stop}\t{tail}\n')
+
+        for transcript_idx in range(gene_offsets[gene_idx], gene_offsets[gene_idx + 1]):
+            head, tail = chunk.transcript_lines[transcript_idx]
+            ouf.write(f'{head}\t{starts[transcript_idx]}\t{stops[transcript_idx]}\t{tail}\n')
+            for idx in range(kept_offsets[transcript_idx], kept_offsets[transcript_idx + 1]):
+                head, tail = chunk.exon_lines[kept_idx[idx]]
+                ouf.write(f'{head}\t{exon_starts[idx]}\t{exon_ends[idx]}\t{tail}\n')
+
+
+def get_replicate_path(path, spec_name, rep_idx, n_replicates):
+    root, ext = os.path.splitext(path)
+    if spec_name is not None:
+        root = f'{root}.{spec_name}'
+    if n_replicates > 1:
+        root = f'{root}.rep{rep_idx}'
+    return f'{root}{ext}'
+
+
+def write_replicate(annot_chunks, spec, seed_seq, transcript_modes, ouf_path, fixed_modes=None):
+    rng = np.random.default_rng(seed_seq)
+    with ExitStack() as stack:
+        modes_ouf = stack.enter_context(AtomicWriter(transcript_modes))
+        ouf = stack.enter_context(AtomicWriter(ouf_path))
+        fixed_modes_ouf = None if fixed_modes is None else stack.enter_context(AtomicWriter(fixed_modes))
+        for chunk in annot_chunks:
+            write_distorted_chunk(chunk, spec, rng, modes_ouf, ouf, fixed_modes_ouf)
+
+
+def main(inf_path, transcript_modes, ouf_path, n_replicates=1, seed=None, n_jobs=1, spec_path=None,
+         fixed_modes=None):
+    '''
+    A single output streams the annotation by chunks, several replicates or specs share the chunks
+    of one parsed annotation. Random streams are spawned from one SeedSequence, per spec and then per replicate,
+    so replicate i does not depend on n_replicates
+    '''
+    l_specs = [DEFAULT_SPEC] if spec_path is None else load_distortion_specs(spec_path)
+    root_seed_seq = np.random.SeedSequence(seed)
+    if len(l_specs) == 1:
+        l_spec_seed_seqs = [root_seed_seq]
+    else:
+        l_spec_seed_seqs = root_seed_seq.spawn(len(l_specs))
+
+    l_tasks = []
+    for spec, spec_seed_seq in zip(l_specs, l_spec_seed_seqs):
+        spec_name = spec.name if len(l_specs) > 1 else None
+        for rep_idx, seed_seq in enumerate(spec_seed_seq.spawn(n_replicates)):
+            l_tasks.append((spec, seed_seq,
+                            get_replicate_path(transcript_modes, spec_name, rep_idx, n_replicates),
+                            get_replicate_path(ouf_path, spec_name, rep_idx, n_replicates),
+                            None if fixed_modes is None else get_replicate_path(fixed_modes, spec_name,
+                                                                                rep_idx, n_replicates)))
+
+    annot_chunks = iter_annot_chunks(iter_gene_blocks(inf_path))
+    if len(l_tasks) > 1:
+        annot_chunks = list(annot_chunks)
+
+    map_with_shared_state(write_replicate, annot_chunks, l_tasks, n_jobs)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    main(args.inf_path, args.transcript_modes_ouf_path, args.ouf_path)
+    main(args.inf_path, args.transcript_modes_ouf_path, args.ouf_path, args.n_replicates, args.seed, args.jobs,
+         args.distortion_spec, args.fixed_modes_ouf_path)
@@ -1,9 +1,15 @@
 import argparse
-import re
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_gtf, parse_attributes
+from flic_utils.writers import AtomicWriter
 
 
 def parser_args():
-    parser = argparse.ArgumentParser(description='This script corrects the transcript group information file based on the distorted annotation')
+    parser = argparse.ArgumentParser(description='This script corrects the transcript group information file based on the distorted annotation. '
+                                                 '01_create_distorted_annot.py --fixed_modes_ouf_path writes the same file directly')
     parser.add_argument('--real_annot', required=True, 
                         help='Path to the real annotation file')
     parser.add_argument('--bad_annot', required=True, 
@@ -16,60 +22,78 @@ def parser_args():
     return parser.parse_args()
 
 
-def read_annot_file(inf_path):
-    transcript_coords = {}
-    with open(inf_path) as inf:
-        for line in inf:
-            line_l = line.strip('\n').split('\t')
-            feat_type = line_l[2]
-            if feat_type == 'transcript':
-                transcript_id = re.findall(r'transcript_id "(.+?)"', line_l[8])[0]
-                transcript_coords[transcript_id] = (int(line_l[3]), int(line_l[4]))
-    return transcript_coords
+def iter_transcript_borders(inf_path):
+    for line_l in iter_gtf(inf_path):
+        if line_l[2] == 'transcript':
+            yield parse_attributes(line_l[8])['transcript_id'], (int(line_l[3]), int(line_l[4]))
+
+
+def _next_transcript(transcripts_iter, transcript):
+    '''
+    Next transcript and whether the transcript ids are still ascending
+    '''
+    next_transcript = next(transcripts_iter, None)
+    return next_transcript, next_transcript is None or next_transcript[0] >= transcript[0]
+
+
+def join_by_dict(real_annot, bad_annot):
+    '''
+    Transcript ids with the same borders in both annotations, only the real borders are kept in memory
+    '''
+    d_real_borders = dict(iter_transcript_borders(real_annot))
+    return {transcript_id for transcript_id, borders in iter_transcript_borders(bad_annot)
+            if d_real_borders.get(transcript_id) == borders}
+
 
+def find_unchanged_transcripts(real_annot, bad_annot):
+    '''
+    Streaming merge join of the transcripts of the two annotations: transcript ids with the same borders.
+    It needs the annotations to list transcripts in the same order (a distorted annotation keeps the order
+    of the real one) or both be sorted by transcript_id, otherwise the borders are joined by dict
+    '''
+    s_unchanged_transcripts = set()
+    real_iter = iter_transcript_borders(real_annot)
+    bad_iter = iter_transcript_borders(bad_annot)
+    real = next(real_iter, None)
+    bad = next(bad_iter, None)
+    is_same_order = True
+    is_sorted = True
 
-def read_mod_info(mod_info_file):
-    d_modes = {}
-    with open(mod_info_file) as inf:
+    while real is not None or bad is not None:
+        if real is not None and bad is not None and real[0] == bad[0]:
+            if real[1] == bad[1]:
+                s_unchanged_transcripts.add(real[0])
+            real, is_real_sorted = _next_transcript(real_iter, real)
+            bad, is_bad_sorted = _next_transcript(bad_iter, bad)
+            is_sorted = is_sorted and is_real_sorted and is_bad_sorted
+        else:
+            is_same_order = False
+            if bad is None or (real is not None and real[0] < bad[0]):
+                real, is_real_sorted = _next_transcript(real_iter, real)
+                is_sorted = is_sorted and is_real_sorted
+            else:
+                bad, is_bad_sorted = _next_transcript(bad_iter, bad)
+                is_sorted = is_sorted and is_bad_sorted
+
+        if not is_same_order and not is_sorted:
+            return join_by_dict(real_annot, bad_annot)
+
+    return s_unchanged_transcripts
+
+
+def main(real_annot, bad_annot, source_modes, ouf_name):
+    '''
+    Only the ids of the transcripts with unchanged borders are kept in memory (and the real borders
+    if the annotations have no common transcript order), the source mode file is streamed to the output
+    '''
+    s_unchanged_transcripts = find_unchanged_transcripts(real_annot, bad_annot)
+
+    with open(source_modes) as inf, AtomicWriter(ouf_name) as ouf:
         for line in inf:
             transcript_id, mode = line.strip('\n').split('\t')
-            d_modes[transcript_id] = mode
-    return d_modes
-
-
-def modify_transcripts(start, stop, orientation, type_mod):
-    modifications_by_groups = {0: (0, 0), 1: (100, 0), 2: (0, -100), 3: (-100, 0), 
-                               4: (0, 100), 5: (100, -100), 6: (-100, 100)}
-    
-    start_add, stop_add = modifications_by_groups[type_mod]
-    if orientation == '+':
-        start_mod = start + start_add
-        stop_mod = stop + stop_add
-    else:
-        start_mod = start - stop_add
-        stop_mod = stop - start_add
-    
-    if stop_mod - start_mod > 0:
-        return start_mod, stop_mod
-    else:
-        return start, stop
-
-    
-def main(real_annot, bad_annot, source_modes, ouf_name):
-    real_transcript_coords = read_annot_file(real_annot)
-    bad_transcript_coords = read_annot_file(bad_annot)
-    d_modes = read_mod_info(source_modes)
-
-    for transcript_id, ref_borders in real_transcript_coords.items():
-        bad_borders = bad_transcript_coords[transcript_id]
-        if ref_borders == bad_borders:
-            d_modes[transcript_id] = '0'
-
-    with open(ouf_name, 'w') as ouf:
-        for key, val in d_modes.items():
-            ouf.write(f'{key}\t{val}\n')
-    
-    return d_modes
+            if transcript_id in s_unchanged_transcripts:
+                mode = '0'
+            ouf.write(f'{transcript_id}\t{mode}\n')
 
 
 if __name__ == '__main__':
@@ -1,85 +1,40 @@
 import argparse
-import re
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from flic_utils.gtf_parser import iter_transcripts
+from flic_utils.gtf_shards import convert_by_chrom_shards
+from flic_utils.iso_store import iso_from_transcript, write_isoforms
+
+
+NON_NUCL_CHROMS = frozenset({'NC_000932.1', 'NC_037304.1'})
 
 
 def parser_args():
     parser = argparse.ArgumentParser(description='This script processes the GTF annotation file and generates isoform structures')
     parser.add_argument('--annot_fpath', required=True, help='Path to the input reference GTF file')
-    parser.add_argument('--ouf_path', required=True, help='Path to the output isoform structure file')
+    parser.add_argument('--ouf_path', required=True, help='Path to the output isoform structure file, a .npz path writes a binary isoform store')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of processes converting chromosome shards of the GTF in parallel. The chromosome byte offsets are cached in a temporary directory')
 
     return parser.parse_args()
 
 
-def create_transcript_struct(leaf_expr_path, introns_struct_path):
-    prev_exon_end = False
-    prev_transcript_start_stop_chrom_orientation = ()
-    introns_s = set()
-    prev_transcript_id = None
-
-    with open(introns_struct_path, 'w') as ouf:
-        ouf.write('')
-
-    with open(leaf_expr_path) as inf:
-        for line in inf:
-            if line[0] == '#':
-                continue
-            line_l = line.strip('\n').split('\t')
-            chrom = line_l[0]
-            if chrom in {'NC_000932.1', 'NC_037304.1'}:  # remove non nucl chromosomes
-                continue
-
-            feat_type = line_l[2]
-            if feat_type == 'transcript':
-                if prev_transcript_id != None:
-                    with open(introns_struct_path, 'a') as ouf:
-                        introns_s = list(introns_s)
-                        ready_iso = []
-                        if introns_s == []:
-                                ready_iso = []
-                        else:
-                            for elem in introns_s:
-                                start, stop = elem
-                                ready_iso.append((start, stop))
-                            ready_iso = sorted(list(ready_iso))
-                        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-                        ouf.write(f'{prev_transcript_start_stop[0]}\t{prev_transcript_start_stop[1]}\t{prev_transcript_start_stop[2]}\t{ready_iso}\t{prev_transcript_start_stop[3]}\t{prev_transcript_id}\n')
+def create_transcript_struct(leaf_expr_path, introns_struct_path, byte_range=None):
+    transcripts = iter_transcripts(leaf_expr_path, skip_chroms=NON_NUCL_CHROMS, byte_range=byte_range)  # remove non nucl chromosomes
+    write_isoforms((iso_from_transcript(transcript, [transcript.transcript_id]) for transcript in transcripts),
+                   introns_struct_path)
 
 
-                prev_exon_end = False
-                introns_s = set()
-                prev_transcript_start_stop = (line_l[0], line_l[6], line_l[3], line_l[4])
-                prev_transcript_id = re.findall(r'transcript_id "(.+?)"', line)[0]
-            if feat_type == 'exon':
-                orientation = line_l[6]
-                start = int(line_l[3])
-                end = int(line_l[4])
-                if orientation == '+':
-                    if not prev_exon_end:
-                        prev_exon_end = end
-                    else:
-                        introns_s.add((prev_exon_end + 1, start - 1))
-                        prev_exon_end = end
-                elif orientation == '-':
-                    if not prev_exon_end:
-                        prev_exon_end = start
-                    else:
-                        introns_s.add((end + 1, prev_exon_end - 1))
-                        prev_exon_end = start
 
-    with open(introns_struct_path, 'a') as ouf:
-        introns_s = list(introns_s)
-        ready_iso = []
-        if introns_s == []:
-                ready_iso = []
-        else:
-            for elem in introns_s:
-                start, stop = elem
-                ready_iso.append((start, stop))
-            ready_iso = sorted(list(ready_iso))
-        ready_iso = ';'.join(['%s-%s' % pos for pos in ready_iso])
-        ouf.write(f'{prev_transcript_start_stop[0]}\t{prev_transcript_start_stop[1]}\t{prev_transcript_start_stop[2]}\t{ready_iso}\t{prev_transcript_start_stop[3]}\t{prev_transcript_id}\n')
+def main(annot_fpath, ouf_path, n_jobs=1):
+    if n_jobs > 1:
+        convert_by_chrom_shards(create_transcript_struct, annot_fpath, ouf_path, n_jobs)
+    else:
+        create_transcript_struct(annot_fpath, ouf_path)
 
 
 if __name__ == '__main__':
     args = parser_args()
-    create_transcript_struct(args.annot_fpath, args.ouf_path)
+    main(args.annot_fpath, args.ouf_path, args.jobs)
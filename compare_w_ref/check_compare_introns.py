@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flic_utils.intron_compare import compare_intron_chains, compare_introns, compare_introns_pairwise
+from flic_utils.iso_store import iter_isoforms
+from flic_utils.junctions import JunctionTable
+
+
+def parser_args():
+    parser = argparse.ArgumentParser(description='This script checks that the sorted compare_introns and '
+                                                 'compare_intron_chains give the same counts as the pairwise '
+                                                 'implementation on every pair of isoforms of every gene')
+    parser.add_argument('--inf_path', required=True,
+                        help='Path to the input file with isoforms structure (TSV or .npz isoform store)')
+    parser.add_argument('--max_iso_per_gene', type=int, default=50,
+                        help='Only the first isoforms of a gene are compared, pairs grow quadratically')
+
+    return parser.parse_args()
+
+
+def read_iso_by_genes(inf_path, junctions):
+    d_iso_by_genes = defaultdict(list)
+    for iso in iter_isoforms(inf_path):
+        gene_id = iso.tail[-1].split('.')[0] + iso.strand
+        d_iso_by_genes[gene_id].append((iso.start[0], list(iso.introns), iso.end[1],
+                                        junctions.intern_chain(iso.chrom, iso.strand, iso.introns)))
+    return d_iso_by_genes
+
+
+def main(inf_path, max_iso_per_gene):
+    n_pairs = 0
+    n_mismatches = 0
+    junctions = JunctionTable()
+    for gene_id, iso_l in read_iso_by_genes(inf_path, junctions).items():
+        iso_l = iso_l[:max_iso_per_gene]
+        for major_struct in iso_l:
+            for compared_struct in iso_l:
+                args = (major_struct[1], compared_struct[1], compared_struct[0], compared_struct[2])
+                expected = compare_introns_pairwise(*args)
+                n_pairs += 1
+                for observed in (compare_introns(*args),
+                                 compare_intron_chains(major_struct[3], compared_struct[3], compared_struct[0],
+                                                       compared_struct[2], junctions)):
+                    if expected != observed:
+                        n_mismatches += 1
+                        print(f'{gene_id[:-1]}\t{expected}\t{observed}')
+
+    print(f'Compared pairs\t{n_pairs}')
+    print(f'Mismatches\t{n_mismatches}')
+    return n_mismatches
+
+
+if __name__ == '__main__':
+    args = parser_args()
+    sys.exit(1 if main(args.inf_path, args.max_iso_per_gene) else 0)
@@ -0,0 +1,147 @@
+import json
+
+from collections import namedtuple
+
+import numpy as np
+
+
+# (start shift, stop shift) in the transcript orientation for every transcript mode:
+# 0 - control, 1 - 5' shorter, 2 - 3' shorter, 3 - 5' longer, 4 - 3' longer,
+# 5 - 5' and 3' shorter, 6 - 5' and 3' longer
+MODE_SHIFTS = np.array([(0, 0), (100, 0), (0, -100), (-100, 0), (0, 100), (100, -100), (-100, 100)], dtype=np.int64)
+N_MODES = len(MODE_SHIFTS)
+
+# shifts: [(start_shift, stop_shift) for every mode], a shift is ('fixed', value),
+# ('uniform', low, high) with both bounds included or ('normal', mean, sd) rounded to an integer.
+# probs: mode probabilities, None for equally likely modes
+DistortionSpec = namedtuple('DistortionSpec', ['name', 'shifts', 'probs'])
+
+DEFAULT_SPEC = DistortionSpec('default', [(('fixed', start), ('fixed', stop)) for start, stop in MODE_SHIFTS.tolist()],
+                              None)
+
+
+def parse_shift(value, scale=1):
+    '''
+    100 -> ('fixed', 100), {"uniform": [50, 150]} -> ('uniform', 50, 150), {"normal": [100, 20]} -> ('normal', 100, 20),
+    all magnitudes are multiplied by scale
+    '''
+    if isinstance(value, (int, float)):
+        return 'fixed', round(value * scale)
+
+    if not isinstance(value, dict) or len(value) != 1:
+        raise ValueError(f'Wrong shift: {value}')
+    (kind, params), = value.items()
+    if kind == 'uniform':
+        low, high = params
+        return 'uniform', round(low * scale), round(high * scale)
+    if kind == 'normal':
+        mean, sd = params
+        return 'normal', mean * scale, sd * scale
+    raise ValueError(f'Unknown shift distribution: {kind}')
+
+
+def parse_spec(d_spec, scale=1, name=None):
+    shifts = [(parse_shift(mode['start'], scale), parse_shift(mode['stop'], scale)) for mode in d_spec['modes']]
+    probs = d_spec.get('probs')
+    if probs is not None:
+        if len(probs) != len(shifts):
+            raise ValueError(f'{len(probs)} mode probabilities for {len(shifts)} modes')
+        probs = np.array(probs, dtype=float) / sum(probs)
+    return DistortionSpec(name or d_spec.get('name', 'spec'), shifts, probs)
+
+
+def load_distortion_specs(spec_path):
+    '''
+    JSON distortion spec:
+    {"name": "pm100", "modes": [{"start": 0, "stop": 0}, {"start": 100, "stop": {"uniform": [-150, -50]}}, ...],
+     "probs": [1, 2, ...], "scales": [0.25, 0.5, 1, 2]}
+    Positive shifts move a border downstream in the transcript orientation, so a positive start shift
+    shortens the 5' end and a positive stop shift lengthens the 3' end. "probs" and "scales" are optional,
+    every scale gives one spec <name>_x<scale> with all shift magnitudes multiplied by it.
+    A sweep is {"sweep": [spec, spec, ...]}
+    '''
+    with open(spec_path) as inf:
+        d_specs = json.load(inf)
+
+    l_specs = []
+    for d_spec in d_specs.get('sweep', [d_specs]):
+        if 'scales' not in d_spec:
+            l_specs.append(parse_spec(d_spec))
+            continue
+        for scale in d_spec['scales']:
+            l_specs.append(parse_spec(d_spec, scale, f"{d_spec.get('name', 'spec')}_x{scale}"))
+
+    l_names = [spec.name for spec in l_specs]
+    if len(set(l_names)) != len(l_names):
+        raise ValueError(f'Distortion spec names are not unique: {l_names}')
+    return l_specs
+
+
+def draw_transcript_shifts(spec, n_transcripts, rng):
+    '''
+    Modes and (start, stop) shifts in the transcript orientation for n_transcripts transcripts.
+    Fixed shifts do not consume random numbers
+    '''
+    n_modes = len(spec.shifts)
+    if spec.probs is None:
+        modes = rng.integers(0, n_modes, size=n_transcripts)
+    else:
+        modes = rng.choice(n_modes, size=n_transcripts, p=spec.probs)
+
+    fixed_shifts = np.array([[shift[1] if shift[0] == 'fixed' else 0 for shift in mode_shifts]
+                             for mode_shifts in spec.shifts], dtype=np.int64)
+    start_add = fixed_shifts[modes, 0]
+    stop_add = fixed_shifts[modes, 1]
+
+    for mode, mode_shifts in enumerate(spec.shifts):
+        for side_add, shift in zip((start_add, stop_add), mode_shifts):
+            if shift[0] == 'fixed':
+                continue
+            is_mode = modes == mode
+            n_mode = int(is_mode.sum())
+            if shift[0] == 'uniform':
+                side_add[is_mode] = rng.integers(shift[1], shift[2] + 1, size=n_mode)
+            else:
+                side_add[is_mode] = np.rint(rng.normal(shift[1], shift[2], size=n_mode)).astype(np.int64)
+
+    return modes, start_add, stop_add
+
+
+def modify_transcripts_batch(starts, stops, is_plus, start_add, stop_add):
+    '''
+    Shifted transcript borders for all transcripts at once. Returns (starts, stops, is_modified),
+    a shift that would leave an empty transcript is not applied
+    '''
+    start_mod = np.where(is_plus, starts + start_add, starts - stop_add)
+    stop_mod = np.where(is_plus, stops + stop_add, stops - start_add)
+
+    is_modified = stop_mod - start_mod > 0
+    return np.where(is_modified, start_mod, starts), np.where(is_modified, stop_mod, stops), is_modified
+
+
+def correct_exons_borders_batch(exon_starts, exon_ends, exon_offsets, starts, stops):
+    '''
+    Exons of all transcripts as flat arrays, exons of transcript i are exon_offsets[i]:exon_offsets[i + 1].
+    Keeps the exons overlapping the new transcript borders (the last exon of the transcript if none does),
+    sorts them by start and moves the outer borders to the transcript borders.
+    Returns (kept_idx, new_starts, new_ends, kept_offsets), kept_idx indexes the input exons
+    '''
+    n_transcripts = len(starts)
+    n_exons = np.diff(exon_offsets)
+    transcript_idx = np.repeat(np.arange(n_transcripts), n_exons)
+
+    is_kept = (exon_ends > starts[transcript_idx]) & (exon_starts < stops[transcript_idx])
+    n_kept = np.bincount(transcript_idx[is_kept], minlength=n_transcripts)
+    is_kept[exon_offsets[1:][(n_kept == 0) & (n_exons > 0)] - 1] = True
+
+    kept_idx = np.flatnonzero(is_kept)
+    kept_idx = kept_idx[np.lexsort((exon_starts[kept_idx], transcript_idx[kept_idx]))]
+    kept_offsets = np.zeros(n_transcripts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(transcript_idx[kept_idx], minlength=n_transcripts), out=kept_offsets[1:])
+
+    new_starts = exon_starts[kept_idx]
+    new_ends = exon_ends[kept_idx]
+    has_exons = n_exons > 0
+    new_starts[kept_offsets[:-1][has_exons]] = starts[has_exons]
+    new_ends[kept_offsets[1:][has_exons] - 1] = stops[has_exons]
+    return kept_idx, new_starts, new_ends, kept_offsets
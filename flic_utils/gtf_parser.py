@@ -0,0 +1,91 @@
+from collections import namedtuple
+
+
+TranscriptRecord = namedtuple('TranscriptRecord', ['chrom', 'strand', 'start', 'end', 'introns',
+                                                   'transcript_id', 'gene_id'])
+
+
+def iter_lines(inf_path, byte_range=None):
+    '''
+    byte_range = (start, end) restricts reading to the lines starting in [start, end),
+    start must point to the beginning of a line
+    '''
+    if byte_range is None:
+        with open(inf_path) as inf:
+            yield from inf
+        return
+
+    start, end = byte_range
+    with open(inf_path, 'rb') as inf:
+        inf.seek(start)
+        pos = start
+        for line in inf:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode()
+
+
+def iter_gtf(inf_path, byte_range=None):
+    for line in iter_lines(inf_path, byte_range):
+        if line[0] == '#' or line == '\n':
+            continue
+        yield line.rstrip('\n').split('\t')
+
+
+def parse_attributes(attr_str):
+    '''
+    Single-pass tokenizer for the 9th GTF column: key "value"; key "value"; ...
+    Only the first occurrence of every key is kept
+    '''
+    d_attrs = {}
+    tokens = attr_str.split('"')
+    for idx in range(0, len(tokens) - 1, 2):
+        key = tokens[idx].rsplit(';', 1)[-1].strip()
+        if key not in d_attrs:
+            d_attrs[key] = tokens[idx + 1]
+    return d_attrs
+
+
+def get_introns(exons_l, strand):
+    '''
+    Exons are expected in the GTF order (descending coordinates for the minus strand)
+    '''
+    introns_s = set()
+    prev_exon_end = None
+    if strand == '+':
+        for start, end in exons_l:
+            if prev_exon_end is not None:
+                introns_s.add((prev_exon_end + 1, start - 1))
+            prev_exon_end = end
+    elif strand == '-':
+        for start, end in exons_l:
+            if prev_exon_end is not None:
+                introns_s.add((end + 1, prev_exon_end - 1))
+            prev_exon_end = start
+    return tuple(sorted(introns_s))
+
+
+def iter_transcripts(inf_path, skip_chroms=frozenset(), byte_range=None):
+    transcript_info = None
+    exons_l = []
+
+    for line_l in iter_gtf(inf_path, byte_range):
+        if line_l[0] in skip_chroms:
+            continue
+
+        feat_type = line_l[2]
+        if feat_type == 'exon':
+            exons_l.append((int(line_l[3]), int(line_l[4])))
+        elif feat_type == 'transcript':
+            if transcript_info is not None:
+                yield TranscriptRecord(*transcript_info[:4], get_introns(exons_l, transcript_info[1]),
+                                       *transcript_info[4:])
+            attrs = parse_attributes(line_l[8])
+            transcript_info = (line_l[0], line_l[6], int(line_l[3]), int(line_l[4]),
+                               attrs.get('transcript_id'), attrs.get('gene_id'))
+            exons_l = []
+
+    if transcript_info is not None:
+        yield TranscriptRecord(*transcript_info[:4], get_introns(exons_l, transcript_info[1]),
+                               *transcript_info[4:])
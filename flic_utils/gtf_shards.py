@@ -0,0 +1,125 @@
+import hashlib
+import os
+import tempfile
+
+from flic_utils.iso_store import ISO_STORE_SUFFIX, concat_tables, is_iso_store, load_iso_table, save_iso_table
+from flic_utils.parallel import map_with_shared_state
+from flic_utils.writers import AtomicWriter
+
+
+COPY_CHUNK_SIZE = 1 << 24
+CHROM_IDX_DIR = os.path.join(tempfile.gettempdir(), 'flic_chrom_idx')
+
+
+def scan_chrom_blocks(inf_path):
+    '''
+    Pre-scan of the GTF: byte ranges (chrom, start, end) of the consecutive lines
+    with the same chromosome, in the file order. Comment lines stay in the current block
+    '''
+    l_blocks = []
+    cur_chrom = None
+    block_start = 0
+    pos = 0
+
+    with open(inf_path, 'rb') as inf:
+        for line in inf:
+            if line[:1] != b'#' and line != b'\n':
+                chrom = line[:line.find(b'\t')]
+                if chrom != cur_chrom:
+                    if cur_chrom is not None:
+                        l_blocks.append((cur_chrom.decode(), block_start, pos))
+                        block_start = pos
+                    cur_chrom = chrom
+            pos += len(line)
+
+    if cur_chrom is not None:
+        l_blocks.append((cur_chrom.decode(), block_start, pos))
+    return l_blocks
+
+
+def get_chrom_idx_path(inf_path):
+    real_path = os.path.realpath(inf_path)
+    return os.path.join(CHROM_IDX_DIR, f'{hashlib.sha1(real_path.encode()).hexdigest()}.chrom_idx')
+
+
+def read_chrom_blocks(inf_path):
+    '''
+    Chromosome blocks of the GTF, loaded from its index in CHROM_IDX_DIR when the path, size and mtime
+    of the GTF match, otherwise scanned and cached there for the next runs. The input directory is never
+    written to, and the blocks are only kept in memory if the cache is not writable
+    '''
+    idx_path = get_chrom_idx_path(inf_path)
+    gtf_stat = os.stat(inf_path)
+    header = f'#{os.path.realpath(inf_path)}\t{gtf_stat.st_size}\t{gtf_stat.st_mtime_ns}\n'
+
+    if os.path.exists(idx_path):
+        with open(idx_path) as inf:
+            if inf.readline() == header:
+                l_blocks = []
+                for line in inf:
+                    chrom, start, end = line.strip('\n').split('\t')
+                    l_blocks.append((chrom, int(start), int(end)))
+                return l_blocks
+
+    l_blocks = scan_chrom_blocks(inf_path)
+    try:
+        os.makedirs(CHROM_IDX_DIR, exist_ok=True)
+        with AtomicWriter(idx_path) as ouf:
+            ouf.write(header)
+            for chrom, start, end in l_blocks:
+                ouf.write(f'{chrom}\t{start}\t{end}\n')
+    except OSError:
+        pass
+    return l_blocks
+
+
+def group_blocks(l_blocks, n_shards):
+    '''
+    Merges consecutive chromosome blocks into about n_shards byte ranges of similar size,
+    a chromosome block is never split
+    '''
+    if not l_blocks:
+        return []
+    total_size = l_blocks[-1][2] - l_blocks[0][1]
+    target_size = total_size / max(n_shards, 1)
+
+    l_shards = []
+    shard_start, shard_end = l_blocks[0][1], l_blocks[0][1]
+    for _, start, end in l_blocks:
+        if shard_end - shard_start >= target_size:
+            l_shards.append((shard_start, shard_end))
+            shard_start = start
+        shard_end = end
+    l_shards.append((shard_start, shard_end))
+    return l_shards
+
+
+def _convert_shard(convert_func, inf_path, shard_path, byte_range):
+    convert_func(inf_path, shard_path, byte_range=byte_range)
+
+
+def convert_by_chrom_shards(convert_func, inf_path, ouf_path, n_jobs, shards_per_job=4):
+    '''
+    Runs convert_func(inf_path, shard_ouf_path, byte_range=...) on chromosome shards of the GTF
+    in n_jobs processes and concatenates the shard outputs in the file order, so the result
+    matches the serial convert_func(inf_path, ouf_path). Isoform store shards are merged into one store
+    '''
+    shard_suffix = ISO_STORE_SUFFIX if is_iso_store(ouf_path) else ''
+    l_shards = group_blocks(read_chrom_blocks(inf_path), n_jobs * shards_per_job)
+    l_tasks = [(inf_path, f'{ouf_path}.shard{idx}{shard_suffix}', byte_range)
+               for idx, byte_range in enumerate(l_shards)]
+    map_with_shared_state(_convert_shard, convert_func, l_tasks, n_jobs)
+
+    try:
+        if is_iso_store(ouf_path):
+            save_iso_table(concat_tables([load_iso_table(shard_path) for _, shard_path, _ in l_tasks]), ouf_path)
+            return
+        with AtomicWriter(ouf_path) as ouf:
+            for _, shard_path, _ in l_tasks:
+                with open(shard_path) as inf:
+                    for chunk in iter(lambda: inf.read(COPY_CHUNK_SIZE), ''):
+                        ouf.write(chunk)
+    finally:
+        for _, shard_path, _ in l_tasks:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
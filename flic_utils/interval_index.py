@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+
+class IntervalIndex:
+    '''
+    Static interval index: intervals are sorted by start and laid out as an implicit
+    binary tree augmented with the max end of every subtree (the layout used by cgranges).
+    A query returns all overlapping intervals in O(log n + k)
+    '''
+    def __init__(self, intervals=()):
+        items = sorted(enumerate(intervals), key=lambda x: x[1][0])
+        self.order = [idx for idx, _ in items]
+        self.starts = [interval[0] for _, interval in items]
+        self.ends = [interval[1] for _, interval in items]
+        self.values = [interval[2] for _, interval in items]
+        self.max_ends = list(self.ends)
+        self.max_level = self._index_core()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _index_core(self):
+        n = len(self.starts)
+        if n == 0:
+            return -1
+        max_ends = self.max_ends
+        last_i = (n - 1) & ~1
+        last = max_ends[last_i]
+
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                el = max_ends[i - x]
+                er = max_ends[i + x] if i + x < n else last
+                max_ends[i] = max(self.ends[i], el, er)
+            last_i = last_i - x if last_i >> k & 1 else last_i + x
+            if last_i < n and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            k += 1
+        return k - 1
+
+    def _query(self, start, end):
+        n = len(self.starts)
+        starts, ends, max_ends = self.starts, self.ends, self.max_ends
+        hits = []
+        if n == 0:
+            return hits
+
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]
+        while stack:
+            k, x, is_left_done = stack.pop()
+            if k <= 3:
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                for i in range(i0, i1):
+                    if starts[i] >= end:
+                        break
+                    if start < ends[i]:
+                        hits.append(i)
+            elif not is_left_done:
+                y = x - (1 << (k - 1))
+                stack.append((k, x, True))
+                if y >= n or max_ends[y] > start:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < end:
+                if start < ends[x]:
+                    hits.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        return hits
+
+    def overlaps(self, start, end):
+        '''
+        Intervals with interval_start < end and start < interval_end,
+        returned as (start, end, value) in the order they were given to the index
+        '''
+        hits = self._query(start, end)
+        hits.sort(key=self.order.__getitem__)
+        return [(self.starts[i], self.ends[i], self.values[i]) for i in hits]
+
+
+def build_index_by_key(d_intervals_by_key):
+    '''
+    {key: {(start, end): value}} -> {key: IntervalIndex}, missing keys give an empty index
+    '''
+    d_index = defaultdict(IntervalIndex)
+    for key, d_intervals in d_intervals_by_key.items():
+        d_index[key] = IntervalIndex([(start, end, value) for (start, end), value in d_intervals.items()])
+    return d_index
@@ -0,0 +1,165 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+
+def is_intersected_introns(start_major, end_major, start_comp, end_comp):
+    max_start = max(start_major, start_comp)
+    min_end = min(end_major, end_comp)
+    if min_end - max_start > 0:
+        return True
+    return False
+
+
+def _get_comp_introns_span(compared_introns, compared_start, compared_end):
+    if compared_introns:
+        return min(intron[0] for intron in compared_introns), max(intron[1] for intron in compared_introns)
+    return compared_end, compared_start
+
+
+def compare_introns_pairwise(major_introns, compared_introns, compared_start, compared_end):
+    '''
+    Reference implementation of compare_introns: every differing major intron
+    is checked against every differing compared intron
+    '''
+    d_introns_compare_for1_iso = {'aib5': 0, 'aib3': 0, 'introns_retention': 0,
+                                  'exon_skip': 0, 'exon_extra': 0}
+
+    major_introns = set(major_introns)
+    compared_introns = set(compared_introns)
+    diff_major_introns = major_introns - compared_introns
+    diff_compared_introns = compared_introns - major_introns
+
+    min_start_comp_intron, max_start_comp_intron = _get_comp_introns_span(compared_introns,
+                                                                          compared_start, compared_end)
+    s_intersected_compared_introns = set()
+    d_n_intersected_major_introns = defaultdict(int)
+
+    for major_intron in diff_major_introns:
+        s_is_intersected = set()
+        start_major, end_major = major_intron
+        if end_major < min_start_comp_intron:
+            if start_major > compared_start:
+                d_introns_compare_for1_iso['introns_retention'] += 1
+            continue
+        if start_major > max_start_comp_intron:
+            if end_major < compared_end:
+                d_introns_compare_for1_iso['introns_retention'] += 1
+            continue
+
+        for compared_intron in diff_compared_introns:
+            start_comp, end_comp = compared_intron
+            is_intersected = is_intersected_introns(start_major, end_major, start_comp, end_comp)
+            s_is_intersected.add(is_intersected)
+            if is_intersected:
+                d_n_intersected_major_introns[major_intron] += 1
+                if compared_intron in s_intersected_compared_introns:
+                    d_introns_compare_for1_iso['exon_skip'] += 1
+
+                if start_major != start_comp:
+                    d_introns_compare_for1_iso['aib5'] += 1
+                if end_major != end_comp:
+                    d_introns_compare_for1_iso['aib3'] += 1
+
+                s_intersected_compared_introns.add(compared_intron)
+
+        if True not in s_is_intersected:
+            d_introns_compare_for1_iso['introns_retention'] += 1
+
+    d_introns_compare_for1_iso['exon_extra'] = len([x for x in d_n_intersected_major_introns.values() if x > 1])
+    d_introns_compare_for1_iso['aib5'] -= d_introns_compare_for1_iso['exon_skip'] + d_introns_compare_for1_iso['exon_extra']
+    d_introns_compare_for1_iso['aib3'] -= d_introns_compare_for1_iso['exon_skip'] + d_introns_compare_for1_iso['exon_extra']
+
+    return d_introns_compare_for1_iso
+
+
+def _count_overlaps(starts, ends, start, end):
+    '''
+    Number of intervals with interval_start < end and start < interval_end, starts and ends sorted.
+    All intervals and (start, end) are non-empty (start < end), so the intervals ending at or
+    before start are a subset of the ones starting before end
+    '''
+    return bisect_left(starts, end) - bisect_right(ends, start)
+
+
+def compare_introns(major_introns, compared_introns, compared_start, compared_end):
+    '''
+    Same counts as compare_introns_pairwise in O((m + n) log(m + n)).
+    The pairwise loop only needs, for every major intron, the number of intersected compared introns
+    and how many of them share its start or end, and for every compared intron the number of
+    intersecting major introns. They are counted with binary searches over the sorted intron borders.
+    Two introns intersect when min(ends) - max(starts) > 0, so an intron with end <= start never intersects
+    '''
+    major_introns = set(major_introns)
+    compared_introns = set(compared_introns)
+    return _count_intron_differences(major_introns - compared_introns, compared_introns - major_introns,
+                                     _get_comp_introns_span(compared_introns, compared_start, compared_end),
+                                     compared_start, compared_end)
+
+
+def compare_intron_chains(major_ids, compared_ids, compared_start, compared_end, junctions):
+    '''
+    compare_introns for intron chains of junction ids of a JunctionTable: the set differences are taken
+    over integer ids and only the differing introns are turned back into coordinates
+    '''
+    major_ids = set(major_ids)
+    compared_ids = set(compared_ids)
+    if compared_ids:
+        comp_span = (min(junctions.starts[junction_id] for junction_id in compared_ids),
+                     max(junctions.ends[junction_id] for junction_id in compared_ids))
+    else:
+        comp_span = (compared_end, compared_start)
+    return _count_intron_differences(junctions.get_introns(major_ids - compared_ids),
+                                     junctions.get_introns(compared_ids - major_ids),
+                                     comp_span, compared_start, compared_end)
+
+
+def _count_intron_differences(diff_major_introns, diff_compared_introns, comp_span, compared_start, compared_end):
+    d_introns_compare_for1_iso = {'aib5': 0, 'aib3': 0, 'introns_retention': 0,
+                                  'exon_skip': 0, 'exon_extra': 0}
+
+    diff_compared_introns = [intron for intron in diff_compared_introns if intron[0] < intron[1]]
+    min_start_comp_intron, max_start_comp_intron = comp_span
+
+    comp_starts = sorted(intron[0] for intron in diff_compared_introns)
+    comp_ends = sorted(intron[1] for intron in diff_compared_introns)
+
+    checked_major_introns = []
+    n_pairs = 0
+    n_same_starts = 0
+    n_same_ends = 0
+    for start_major, end_major in diff_major_introns:
+        if end_major < min_start_comp_intron:
+            if start_major > compared_start:
+                d_introns_compare_for1_iso['introns_retention'] += 1
+            continue
+        if start_major > max_start_comp_intron:
+            if end_major < compared_end:
+                d_introns_compare_for1_iso['introns_retention'] += 1
+            continue
+
+        n_intersected = 0
+        if start_major < end_major:
+            n_intersected = _count_overlaps(comp_starts, comp_ends, start_major, end_major)
+        if n_intersected == 0:
+            d_introns_compare_for1_iso['introns_retention'] += 1
+            continue
+
+        checked_major_introns.append((start_major, end_major))
+        n_pairs += n_intersected
+        n_same_starts += bisect_right(comp_starts, start_major) - bisect_left(comp_starts, start_major)
+        n_same_ends += bisect_right(comp_ends, end_major) - bisect_left(comp_ends, end_major)
+        if n_intersected > 1:
+            d_introns_compare_for1_iso['exon_extra'] += 1
+
+    major_starts = sorted(intron[0] for intron in checked_major_introns)
+    major_ends = sorted(intron[1] for intron in checked_major_introns)
+    for start_comp, end_comp in diff_compared_introns:
+        n_intersected = _count_overlaps(major_starts, major_ends, start_comp, end_comp)
+        if n_intersected > 1:
+            d_introns_compare_for1_iso['exon_skip'] += n_intersected - 1
+
+    n_skip_and_extra = d_introns_compare_for1_iso['exon_skip'] + d_introns_compare_for1_iso['exon_extra']
+    d_introns_compare_for1_iso['aib5'] = n_pairs - n_same_starts - n_skip_and_extra
+    d_introns_compare_for1_iso['aib3'] = n_pairs - n_same_ends - n_skip_and_extra
+
+    return d_introns_compare_for1_iso
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def segment_sums(values, offsets):
+    '''
+    Sums of values[offsets[i]:offsets[i + 1]] for every segment, empty segments give 0
+    '''
+    n_values = np.diff(offsets)
+    sums = np.zeros(len(n_values), dtype=np.int64)
+    is_non_empty = n_values > 0
+    if is_non_empty.any():
+        sums[is_non_empty] = np.add.reduceat(values.astype(np.int64), offsets[:-1][is_non_empty])
+    return sums
+
+
+def calc_iso_stats(table):
+    '''
+    Per-isoform statistics of an IsoformTable computed for the whole table at once.
+    The isoform spans from the first start coordinate to the last end coordinate,
+    the exons are the gaps between the introns inside this span
+    '''
+    iso_start = table.start[:, 0].astype(np.int64)
+    iso_end = table.end[:, 1].astype(np.int64)
+    offsets = np.asarray(table.intron_offsets)
+
+    n_introns = np.diff(offsets)
+    iso_len = iso_end - iso_start + 1
+    sum_introns_len = segment_sums(table.introns[:, 1] - table.introns[:, 0] + 1, offsets)
+    sum_exons_len = iso_len - sum_introns_len
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_introns_len = np.round(sum_introns_len / n_introns, 1)
+    mean_exons_len = np.round(sum_exons_len / (n_introns + 1), 1)
+
+    return {'n_introns': n_introns, 'iso_len': iso_len, 'mean_introns_len': mean_introns_len,
+            'mean_exons_len': mean_exons_len, 'sum_exons_len': sum_exons_len}
+
+
+def format_means(means, n_values):
+    '''
+    Means as strings, 'NA' where there was nothing to average
+    '''
+    return ['NA' if n == 0 else str(mean) for mean, n in zip(means.tolist(), n_values.tolist())]
+
+
+def decode_id_columns(table):
+    '''
+    Chromosome, strand and transcript id (the last trailing column) of every isoform as str lists
+    '''
+    chrom_names = table.chrom_names.tolist()
+    chrom_l = [chrom_names[code] for code in table.chrom.tolist()]
+    strand_l = [strand.decode() for strand in table.strand.tolist()]
+    transcript_id_l = [tail.decode().rsplit('\t', 1)[-1] for tail in table.tail.tolist()]
+    return chrom_l, strand_l, transcript_id_l
@@ -0,0 +1,273 @@
+import os
+import struct
+import zipfile
+
+from collections import namedtuple
+
+import numpy as np
+
+from flic_utils.writers import AtomicWriter
+
+
+ISO_STORE_SUFFIX = '.npz'
+
+IsoRecord = namedtuple('IsoRecord', ['chrom', 'strand', 'start', 'introns', 'end', 'tail', 'is_peak'])
+IsoformTable = namedtuple('IsoformTable', ['chrom_names', 'chrom', 'strand', 'start', 'end', 'is_peak',
+                                           'intron_offsets', 'introns', 'tail'])
+
+
+def is_iso_store(path):
+    return path.endswith(ISO_STORE_SUFFIX)
+
+
+def parse_introns(introns_str):
+    if introns_str == '':
+        return ()
+    return tuple(tuple(map(int, elem.split('-'))) for elem in introns_str.split(';'))
+
+
+def parse_coord(coord_str):
+    '''
+    '100' -> (100, 100), '90-110' -> (90, 110)
+    '''
+    coord_l = coord_str.split('-')
+    if len(coord_l) == 1:
+        coord = int(coord_str)
+        return coord, coord
+    return int(coord_l[0]), int(coord_l[1])
+
+
+def format_introns(introns):
+    return ';'.join(['%s-%s' % pos for pos in introns])
+
+
+def format_coord(coord, is_peak):
+    if is_peak:
+        return f'{coord[0]}-{coord[1]}'
+    return str(coord[0])
+
+
+def parse_iso_line(line):
+    line_l = line.rstrip('\n').split('\t')
+    return IsoRecord(line_l[0], line_l[1], parse_coord(line_l[2]), parse_introns(line_l[3]),
+                     parse_coord(line_l[4]), line_l[5:], '-' in line_l[2])
+
+
+def format_iso_line(iso):
+    line_l = [iso.chrom, iso.strand, format_coord(iso.start, iso.is_peak), format_introns(iso.introns),
+              format_coord(iso.end, iso.is_peak), *iso.tail]
+    return '\t'.join(line_l) + '\n'
+
+
+def table_from_records(records):
+    chrom_codes = {}
+    chrom_l, strand_l, start_l, end_l, is_peak_l, tail_l = [], [], [], [], [], []
+    intron_offsets = [0]
+    introns_l = []
+
+    for iso in records:
+        if iso.chrom not in chrom_codes:
+            chrom_codes[iso.chrom] = len(chrom_codes)
+        chrom_l.append(chrom_codes[iso.chrom])
+        strand_l.append(iso.strand)
+        start_l.append(iso.start)
+        end_l.append(iso.end)
+        is_peak_l.append(iso.is_peak)
+        introns_l.extend(iso.introns)
+        intron_offsets.append(len(introns_l))
+        tail_l.append('\t'.join(iso.tail))
+
+    return IsoformTable(chrom_names=np.array(list(chrom_codes), dtype=str),
+                        chrom=np.array(chrom_l, dtype=np.int32),
+                        strand=np.array(strand_l, dtype='S1'),
+                        start=np.array(start_l, dtype=np.int32).reshape(-1, 2),
+                        end=np.array(end_l, dtype=np.int32).reshape(-1, 2),
+                        is_peak=np.array(is_peak_l, dtype=bool),
+                        intron_offsets=np.array(intron_offsets, dtype=np.int64),
+                        introns=np.array(introns_l, dtype=np.int32).reshape(-1, 2),
+                        tail=np.array([tail.encode() for tail in tail_l], dtype=bytes))
+
+
+def concat_tables(tables):
+    if not tables:
+        return table_from_records([])
+
+    l_chrom_names = []
+    d_chrom_codes = {}
+    l_chrom = []
+    l_offsets = [np.zeros(1, dtype=np.int64)]
+    n_introns = 0
+
+    for table in tables:
+        remap = np.empty(len(table.chrom_names), dtype=np.int32)
+        for code, chrom in enumerate(table.chrom_names.tolist()):
+            if chrom not in d_chrom_codes:
+                d_chrom_codes[chrom] = len(l_chrom_names)
+                l_chrom_names.append(chrom)
+            remap[code] = d_chrom_codes[chrom]
+        l_chrom.append(remap[table.chrom])
+        l_offsets.append(table.intron_offsets[1:] + n_introns)
+        n_introns += len(table.introns)
+
+    tail_l = [table.tail for table in tables]
+    tail_width = max([tail.dtype.itemsize for tail in tail_l] + [1])
+    return IsoformTable(chrom_names=np.array(l_chrom_names, dtype=str),
+                        chrom=np.concatenate(l_chrom) if l_chrom else np.zeros(0, dtype=np.int32),
+                        strand=np.concatenate([table.strand for table in tables]),
+                        start=np.concatenate([table.start for table in tables]),
+                        end=np.concatenate([table.end for table in tables]),
+                        is_peak=np.concatenate([table.is_peak for table in tables]),
+                        intron_offsets=np.concatenate(l_offsets),
+                        introns=np.concatenate([table.introns for table in tables]),
+                        tail=np.concatenate([tail.astype(f'S{tail_width}') for tail in tail_l]))
+
+
+def save_iso_table(table, ouf_path):
+    '''
+    Uncompressed .npz, so that every column can be memory-mapped by load_iso_table
+    '''
+    tmp_path = f'{ouf_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as ouf:
+            np.savez(ouf, **table._asdict())
+        os.replace(tmp_path, ouf_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_iso_table(inf_path):
+    '''
+    Zero-copy load: the arrays are read-only memory maps over the members of the .npz
+    '''
+    d_arrays = {}
+    with zipfile.ZipFile(inf_path) as zf, open(inf_path, 'rb') as inf:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                d_arrays[name] = np.load(inf_path)[name]
+                continue
+
+            inf.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', inf.read(30)[26:30])
+            inf.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(inf)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(inf)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(inf)
+
+            if 0 in shape:
+                d_arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                d_arrays[name] = np.memmap(inf_path, dtype=dtype, mode='r', offset=inf.tell(), shape=shape,
+                                           order='F' if fortran_order else 'C')
+    return IsoformTable(**d_arrays)
+
+
+def read_iso_tsv(inf_path):
+    with open(inf_path) as inf:
+        return table_from_records(parse_iso_line(line) for line in inf if line[0] != '#')
+
+
+def read_iso_table(inf_path):
+    if is_iso_store(inf_path):
+        return load_iso_table(inf_path)
+    return read_iso_tsv(inf_path)
+
+
+def iter_table(table):
+    chrom_names = table.chrom_names.tolist()
+    chrom_l = table.chrom.tolist()
+    strand_l = [strand.decode() for strand in table.strand.tolist()]
+    start_l = table.start.tolist()
+    end_l = table.end.tolist()
+    is_peak_l = table.is_peak.tolist()
+    offsets = table.intron_offsets.tolist()
+    introns_l = [tuple(intron) for intron in table.introns.tolist()]
+    tail_l = table.tail.tolist()
+
+    for idx in range(len(chrom_l)):
+        tail = tail_l[idx].decode()
+        yield IsoRecord(chrom_names[chrom_l[idx]], strand_l[idx], tuple(start_l[idx]),
+                        tuple(introns_l[offsets[idx]:offsets[idx + 1]]), tuple(end_l[idx]),
+                        tail.split('\t') if tail else [], is_peak_l[idx])
+
+
+def iter_isoforms(inf_path):
+    '''
+    Isoform records from either an isoform structure TSV or an isoform store,
+    comment lines of the TSV are skipped
+    '''
+    if is_iso_store(inf_path):
+        yield from iter_table(load_iso_table(inf_path))
+        return
+
+    with open(inf_path) as inf:
+        for line in inf:
+            if line[0] == '#':
+                continue
+            yield parse_iso_line(line)
+
+
+def iso_from_transcript(transcript, tail=()):
+    return IsoRecord(transcript.chrom, transcript.strand, (transcript.start, transcript.start), transcript.introns,
+                     (transcript.end, transcript.end), list(tail), False)
+
+
+class IsoformWriter:
+    '''
+    Writes isoform records one by one: an isoform structure TSV is streamed through an AtomicWriter,
+    an isoform store (ouf_path ending with .npz) is collected and saved on close
+    '''
+    def __init__(self, ouf_path):
+        self.ouf_path = ouf_path
+        if is_iso_store(ouf_path):
+            self._records = []
+            self._ouf = None
+        else:
+            self._records = None
+            self._ouf = AtomicWriter(ouf_path)
+
+    def write(self, iso):
+        if self._ouf is None:
+            self._records.append(iso)
+        else:
+            self._ouf.write(format_iso_line(iso))
+
+    def close(self):
+        if self._ouf is None:
+            if self._records is not None:
+                save_iso_table(table_from_records(self._records), self.ouf_path)
+                self._records = None
+        else:
+            self._ouf.close()
+
+    def abort(self):
+        if self._ouf is None:
+            self._records = None
+        else:
+            self._ouf.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def write_isoforms(records, ouf_path):
+    '''
+    Writes an isoform store if ouf_path ends with .npz, otherwise an isoform structure TSV
+    '''
+    if is_iso_store(ouf_path):
+        save_iso_table(table_from_records(records), ouf_path)
+        return
+
+    with AtomicWriter(ouf_path) as ouf:
+        for iso in records:
+            ouf.write(format_iso_line(iso))
@@ -0,0 +1,56 @@
+INT32_MAX = (1 << 31) - 1
+HASH_MASK = (1 << 64) - 1
+
+
+def chain_hash(junction_ids):
+    '''
+    64-bit hash of an intron chain given as junction ids. Integer tuples hash the same way in every process,
+    so the value can be stored and compared instead of the chain
+    '''
+    return hash(tuple(junction_ids)) & HASH_MASK
+
+
+class JunctionTable:
+    '''
+    Interns (chrom, strand, start, end) introns to consecutive int32 ids, so that an intron chain becomes
+    a tuple of ids: equal chains, set differences and dictionary keys are integer operations.
+    starts[id] and ends[id] keep the coordinates
+    '''
+    def __init__(self):
+        self.d_ids = {}
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def intern(self, chrom, strand, start, end):
+        key = (chrom, strand, start, end)
+        junction_id = self.d_ids.get(key)
+        if junction_id is None:
+            junction_id = len(self.starts)
+            if junction_id > INT32_MAX:
+                raise ValueError(f'More than {INT32_MAX + 1} distinct introns')
+            self.d_ids[key] = junction_id
+            self.starts.append(start)
+            self.ends.append(end)
+        return junction_id
+
+    def intern_chain(self, chrom, strand, introns):
+        return tuple(self.intern(chrom, strand, start, end) for start, end in introns)
+
+    def find_chain(self, chrom, strand, introns):
+        '''
+        Junction ids of an intron chain without interning it, None if one of its introns is unknown:
+        such a chain cannot be equal to any interned one
+        '''
+        junction_ids = []
+        for start, end in introns:
+            junction_id = self.d_ids.get((chrom, strand, start, end))
+            if junction_id is None:
+                return None
+            junction_ids.append(junction_id)
+        return tuple(junction_ids)
+
+    def get_introns(self, junction_ids):
+        return [(self.starts[junction_id], self.ends[junction_id]) for junction_id in junction_ids]
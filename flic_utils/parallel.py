@@ -0,0 +1,27 @@
+import multiprocessing as mp
+
+
+_SHARED_STATE = None
+
+
+def _call_with_shared_state(task):
+    func, args = task
+    return func(_SHARED_STATE, *args)
+
+
+def map_with_shared_state(func, shared_state, args_l, n_jobs=1):
+    '''
+    Runs func(shared_state, *args) for every args in args_l and returns the results in the order of args_l.
+    With n_jobs > 1 the read-only shared_state is stored in a module global before the pool is forked,
+    so the workers inherit it instead of receiving a pickled copy with every task
+    '''
+    global _SHARED_STATE
+    if n_jobs <= 1 or len(args_l) <= 1:
+        return [func(shared_state, *args) for args in args_l]
+
+    _SHARED_STATE = shared_state
+    try:
+        with mp.get_context('fork').Pool(min(n_jobs, len(args_l))) as pool:
+            return pool.map(_call_with_shared_state, [(func, args) for args in args_l], chunksize=1)
+    finally:
+        _SHARED_STATE = None
@@ -0,0 +1,85 @@
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import accumulate
+
+
+def iter_cagefightr_peaks(inf_path):
+    '''
+    CAGEfightR BED peaks as 1-based (chrom, strand, start, end, summit),
+    the summit is the middle of the thick part of the peak
+    '''
+    with open(inf_path) as inf:
+        for line in inf:
+            line_l = line.strip('\n').split('\t')
+            start_peak = int(line_l[1]) + 1
+            end_peak = int(line_l[2])
+            max_start_peak = int(line_l[6]) + 1
+            max_end_peak = int(line_l[7])
+            max_peak = int(round((max_end_peak - max_start_peak) / 2 + max_start_peak, 0))
+            yield line_l[0], line_l[5], start_peak, end_peak, max_peak
+
+
+def read_peak_width(peak_width_fpath):
+    '''
+    {gene_id: (TSS half width, PA half width)} from the peak width by genes file
+    '''
+    d_peak_width_by_genes = {}
+    with open(peak_width_fpath) as inf:
+        for line in inf:
+            if line[0] == '#':
+                continue
+            gene_id, tss, pa = line.strip('\n').split('\t')
+            d_peak_width_by_genes[gene_id] = (int(round(int(tss) / 2, 0)), int(round(int(pa) / 2, 0)))
+    return d_peak_width_by_genes
+
+
+class PeakIndex:
+    '''
+    Peaks of one chromosome strand as arrays sorted by start, with the running max of the peak ends
+    so that the peaks containing a position are found by a binary search and a short backward scan
+    '''
+    def __init__(self, peaks=()):
+        items = sorted(peaks, key=lambda x: x[0])
+        self.starts = [peak[0] for peak in items]
+        self.ends = [peak[1] for peak in items]
+        self.summits = [peak[2] for peak in items]
+        self.max_ends = list(accumulate(self.ends, max))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find_exact(self, start, end):
+        '''
+        Summit of the peak with exactly these borders, the last given one for duplicated peaks, None if there is none
+        '''
+        idx = bisect_right(self.starts, start) - 1
+        while idx >= 0 and self.starts[idx] == start:
+            if self.ends[idx] == end:
+                return self.summits[idx]
+            idx -= 1
+        return None
+
+    def find_containing(self, start, end):
+        '''
+        Summit of the peak containing start..end with the closest start, None if there is none
+        '''
+        idx = bisect_right(self.starts, start) - 1
+        while idx >= 0 and self.max_ends[idx] >= end:
+            if self.ends[idx] >= end:
+                return self.summits[idx]
+            idx -= 1
+        return None
+
+
+def build_peak_indexes(peaks):
+    '''
+    (chrom, strand, start, end, summit) peaks -> {(chrom, strand): PeakIndex}, missing keys give an empty index
+    '''
+    d_peaks = defaultdict(list)
+    for chrom, strand, start, end, summit in peaks:
+        d_peaks[chrom, strand].append((start, end, summit))
+
+    d_index = defaultdict(PeakIndex)
+    for key, peaks_l in d_peaks.items():
+        d_index[key] = PeakIndex(peaks_l)
+    return d_index
@@ -0,0 +1,60 @@
+import os
+
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+class AtomicWriter:
+    '''
+    Buffered writer keeping a single handle open on a temporary file next to ouf_path.
+    Lines are collected in memory and written in batches of about buffer_size characters.
+    The temporary file is renamed to ouf_path only on close(), so a crashed run
+    never leaves a half-written output behind
+    '''
+    def __init__(self, ouf_path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.ouf_path = ouf_path
+        self.buffer_size = buffer_size
+        self.tmp_path = f'{ouf_path}.{os.getpid()}.tmp'
+        self._ouf = open(self.tmp_path, 'w', buffering=buffer_size)
+        self._buffer = []
+        self._buffered_len = 0
+
+    def write(self, line):
+        self._buffer.append(line)
+        self._buffered_len += len(line)
+        if self._buffered_len >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buffer:
+            self._ouf.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered_len = 0
+
+    def close(self):
+        if self._ouf.closed:
+            return
+        self.flush()
+        self._ouf.close()
+        os.replace(self.tmp_path, self.ouf_path)
+
+    def abort(self):
+        if self._ouf.closed:
+            return
+        self._buffer = []
+        self._ouf.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
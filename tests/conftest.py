@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+
+@pytest.fixture(scope='session')
+def load_script():
+    '''
+    Imports a numbered pipeline script as a module by its path relative to the repository root
+    '''
+    def load(rel_path):
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(rel_path))[0],
+                                                      os.path.join(ROOT_DIR, rel_path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
@@ -0,0 +1,136 @@
+import random
+
+import pytest
+
+from flic_utils.iso_store import IsoRecord, write_isoforms
+from flic_utils.junctions import JunctionTable
+
+
+SCRIPT_PATH = 'benchmarking/analyze_res_of_reconstruction/07_compare_recontructed_iso_w_ref.py'
+THRESHOLDS = [1, 2, 5, 10]
+BP_TOLERANCES = [0, 3, 10, 25]
+WIDTH_SCALES = [0.5, 1.0, 2.0]
+
+
+@pytest.fixture(scope='module')
+def compare_07(load_script):
+    return load_script(SCRIPT_PATH)
+
+
+def make_data(rng, n_genes=30):
+    '''
+    Reference isoforms {gene_id: [(transcript_id, iso), ...]} sharing a few intron chains per gene, their
+    expression levels, peak widths and reconstructed isoforms (points and peak windows) near the references
+    '''
+    d_ref_isoforms, d_levels, d_peak_width_by_genes, recon_l = {}, {}, {}, []
+    for gene_idx in range(n_genes):
+        gene_id = f'G{gene_idx}'
+        strand = rng.choice('+-')
+        chains = [((100, 200), (300, 400)), ((100, 200), (250, 400)), ((150, 200),)]
+        d_ref_isoforms[gene_id] = []
+        for transcript_idx in range(rng.randint(1, 6)):
+            transcript_id = f'{gene_id}.{transcript_idx}'
+            start, end = rng.randint(40, 60), rng.randint(440, 460)
+            iso = IsoRecord('chr1', strand, (start, start), rng.choice(chains), (end, end), [transcript_id], False)
+            d_ref_isoforms[gene_id].append((transcript_id, iso))
+            d_levels[transcript_id] = rng.choice([0, 0, 1, 2, 3, 5, 8, 12, 30])
+        d_peak_width_by_genes[gene_id] = (rng.randint(0, 6), rng.randint(0, 6))
+
+        for _ in range(rng.randint(0, 6)):
+            _, ref_iso = rng.choice(d_ref_isoforms[gene_id])
+            start = ref_iso.start[0] + rng.choice([0, 0, 0, 2, -3, 8, -20])
+            end = ref_iso.end[0] + rng.choice([0, 0, 0, -2, 3, -8, 20])
+            introns = rng.choice([ref_iso.introns] * 3 + chains + [((100, 210),)])
+            if rng.random() < 0.5:
+                start_half, end_half = rng.randint(0, 5), rng.randint(0, 5)
+                recon_l.append(IsoRecord('chr1', strand, (start - start_half, start + start_half), introns,
+                                         (end - end_half, end + end_half), [gene_id], True))
+            else:
+                recon_l.append(IsoRecord('chr1', strand, (start, start), introns, (end, end), [gene_id], False))
+    recon_l.append(IsoRecord('chr1', '+', (50, 50), (), (450, 450), ['not_simulated'], False))
+    return d_ref_isoforms, d_levels, d_peak_width_by_genes, recon_l
+
+
+def count_by_scan(d_ref_isoforms, d_levels, recon_l, threshold, get_slacks):
+    '''
+    Reference crediting: a reconstructed isoform matches a reference isoform with the same introns whose start
+    and end fall into its windows widened by get_slacks(iso) = (start slack, end slack). Every reconstructed
+    isoform is credited to its first well expressed match (TP), it is a FP if its gene has a well expressed
+    transcript and none matches, a TN if its gene has a poorly expressed transcript and none matches
+    '''
+    tp = set()
+    fp = 0
+    tn = 0
+    for iso in recon_l:
+        gene_id = iso.tail[-1]
+        if gene_id not in d_ref_isoforms:
+            continue
+        start_slack, end_slack = get_slacks(iso)
+        matches_l = [transcript_id for transcript_id, ref_iso in d_ref_isoforms[gene_id]
+                     if ref_iso.introns == iso.introns and
+                     iso.start[0] - start_slack <= ref_iso.start[0] <= iso.start[1] + start_slack and
+                     iso.end[0] - end_slack <= ref_iso.end[0] <= iso.end[1] + end_slack]
+        pos_matches_l = [transcript_id for transcript_id in matches_l if d_levels[transcript_id] >= threshold]
+        levels_l = [d_levels[transcript_id] for transcript_id, _ in d_ref_isoforms[gene_id]]
+
+        if pos_matches_l:
+            tp.add(pos_matches_l[0])
+        elif max(levels_l) >= threshold:
+            fp += 1
+        if min(levels_l) < threshold and len(pos_matches_l) == len(matches_l):
+            tn += 1
+    return tp, fp, tn
+
+
+def prep_ref_index(compare_07, d_ref_isoforms, d_levels):
+    junctions = JunctionTable()
+    d_ref_index = compare_07.index_ref_isoforms(d_ref_isoforms, junctions)
+    d_gene_levels = {}
+    for gene_id, ref_iso_l in d_ref_isoforms.items():
+        levels_l = [d_levels[transcript_id] for transcript_id, _ in ref_iso_l]
+        d_gene_levels[gene_id] = (min(levels_l), max(levels_l))
+    return d_ref_index, d_levels, d_gene_levels, junctions
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_counts_by_thresholds_match_scan(compare_07, tmp_path, seed):
+    d_ref_isoforms, d_levels, _, recon_l = make_data(random.Random(seed))
+    recon_fpath = str(tmp_path / 'tool.tsv')
+    write_isoforms(recon_l, recon_fpath)
+
+    summary = compare_07.collect_matches(recon_fpath, *prep_ref_index(compare_07, d_ref_isoforms, d_levels))
+    tp, fp, tn = compare_07.calc_counts_by_thresholds(summary, d_levels, THRESHOLDS)
+    for idx, threshold in enumerate(THRESHOLDS):
+        expected_tp, expected_fp, expected_tn = count_by_scan(d_ref_isoforms, d_levels, recon_l, threshold,
+                                                              lambda iso: (0, 0))
+        assert compare_07.get_tp_transcripts(summary, d_levels, threshold) == expected_tp
+        assert (tp[idx], fp[idx], tn[idx]) == (len(expected_tp), expected_fp, expected_tn)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_counts_by_tolerances_match_scan(compare_07, tmp_path, seed):
+    d_ref_isoforms, d_levels, d_peak_width_by_genes, recon_l = make_data(random.Random(seed))
+    recon_fpath = str(tmp_path / 'tool.tsv')
+    write_isoforms(recon_l, recon_fpath)
+    ref_index = prep_ref_index(compare_07, d_ref_isoforms, d_levels)
+    threshold = compare_07.DEFAULT_EXPR_THRESHOLD
+
+    distances = compare_07.collect_border_distances(recon_fpath, *ref_index, max(BP_TOLERANCES))
+    params_l, tp, fp, tn = compare_07.evaluate_tolerances(distances, BP_TOLERANCES, [], threshold)
+    assert params_l == [('bp', tolerance) for tolerance in BP_TOLERANCES]
+    for idx, tolerance in enumerate(BP_TOLERANCES):
+        expected_tp, expected_fp, expected_tn = count_by_scan(d_ref_isoforms, d_levels, recon_l, threshold,
+                                                              lambda iso: (tolerance, tolerance))
+        assert (tp[idx], fp[idx], tn[idx]) == (len(expected_tp), expected_fp, expected_tn)
+
+    max_dist = int(max(WIDTH_SCALES) * max(max(widths) for widths in d_peak_width_by_genes.values())) + 1
+    distances = compare_07.collect_border_distances(recon_fpath, *ref_index, max_dist, d_peak_width_by_genes)
+    params_l, tp, fp, tn = compare_07.evaluate_tolerances(distances, [], WIDTH_SCALES, threshold)
+    assert params_l == [('width_scale', scale) for scale in WIDTH_SCALES]
+    for idx, scale in enumerate(WIDTH_SCALES):
+        def get_slacks(iso):
+            start_width, end_width = compare_07.get_border_widths(d_peak_width_by_genes, iso.tail[-1], iso.strand)
+            return scale * start_width, scale * end_width
+        expected_tp, expected_fp, expected_tn = count_by_scan(d_ref_isoforms, d_levels, recon_l, threshold,
+                                                              get_slacks)
+        assert (tp[idx], fp[idx], tn[idx]) == (len(expected_tp), expected_fp, expected_tn)
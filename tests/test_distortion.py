@@ -0,0 +1,89 @@
+import random
+
+import numpy as np
+import pytest
+
+from flic_utils.distortion import MODE_SHIFTS, correct_exons_borders_batch, modify_transcripts_batch
+
+
+def modify_transcript(start, stop, orientation, start_add, stop_add):
+    '''
+    Per transcript reference of modify_transcripts_batch
+    '''
+    if orientation == '+':
+        start_mod = start + start_add
+        stop_mod = stop + stop_add
+    else:
+        start_mod = start - stop_add
+        stop_mod = stop - start_add
+
+    if stop_mod - start_mod > 0:
+        return start_mod, stop_mod
+    return start, stop
+
+
+def correct_exons_borders(exons_l, start_transcript, stop_transcript):
+    '''
+    Per transcript reference of correct_exons_borders_batch, exons are [input index, start, end]
+    '''
+    new_exons_l = []
+    for cur_exon in exons_l:
+        if cur_exon[2] > start_transcript and cur_exon[1] < stop_transcript:
+            new_exons_l.append(list(cur_exon))
+
+    if not new_exons_l:
+        new_exons_l.append(list(exons_l[-1]))
+
+    new_exons_l.sort(key=lambda x: x[1])
+    new_exons_l[0][1] = start_transcript
+    new_exons_l[-1][2] = stop_transcript
+    return [tuple(exon) for exon in new_exons_l]
+
+
+def make_transcripts(rng, n_transcripts):
+    '''
+    Transcripts as (start, stop, orientation, exons) with a few short ones, so that some shifts
+    leave an empty transcript or move the borders past whole exons. Exons come in a random order
+    '''
+    transcripts_l = []
+    exon_idx = 0
+    for _ in range(n_transcripts):
+        pos = rng.randint(1, 1000)
+        exons_l = []
+        for _ in range(rng.randint(1, 5)):
+            start = pos + rng.randint(0, 80)
+            pos = start + rng.randint(1, 150)
+            exons_l.append([exon_idx, start, pos])
+            exon_idx += 1
+        rng.shuffle(exons_l)
+        transcripts_l.append((min(exon[1] for exon in exons_l), max(exon[2] for exon in exons_l),
+                              rng.choice('+-'), exons_l))
+    return transcripts_l
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_distortion_matches_per_transcript(seed):
+    rng = random.Random(seed)
+    transcripts_l = make_transcripts(rng, 300)
+    modes = np.array([rng.randrange(len(MODE_SHIFTS)) for _ in transcripts_l], dtype=np.int64)
+    start_add, stop_add = MODE_SHIFTS[modes, 0], MODE_SHIFTS[modes, 1]
+
+    starts = np.array([transcript[0] for transcript in transcripts_l], dtype=np.int64)
+    stops = np.array([transcript[1] for transcript in transcripts_l], dtype=np.int64)
+    is_plus = np.array([transcript[2] == '+' for transcript in transcripts_l], dtype=bool)
+    new_starts, new_stops, is_modified = modify_transcripts_batch(starts, stops, is_plus, start_add, stop_add)
+
+    exons_l = [exon for transcript in transcripts_l for exon in transcript[3]]
+    exon_offsets = np.cumsum([0] + [len(transcript[3]) for transcript in transcripts_l])
+    kept_idx, exon_starts, exon_ends, kept_offsets = correct_exons_borders_batch(
+        np.array([exon[1] for exon in exons_l], dtype=np.int64), np.array([exon[2] for exon in exons_l], dtype=np.int64),
+        exon_offsets, new_starts, new_stops)
+    batch_exons_l = [(exons_l[idx][0], start, end)
+                     for idx, start, end in zip(kept_idx.tolist(), exon_starts.tolist(), exon_ends.tolist())]
+
+    assert not is_modified.all()
+    for idx, (start, stop, orientation, transcript_exons_l) in enumerate(transcripts_l):
+        new_borders = modify_transcript(start, stop, orientation, int(start_add[idx]), int(stop_add[idx]))
+        assert (new_starts[idx], new_stops[idx]) == new_borders
+        assert (batch_exons_l[kept_offsets[idx]:kept_offsets[idx + 1]] ==
+                correct_exons_borders(transcript_exons_l, *new_borders))
@@ -0,0 +1,36 @@
+import random
+
+import pytest
+
+from flic_utils.interval_index import IntervalIndex, build_index_by_key
+
+
+def overlaps_by_scan(intervals, start, end):
+    return [interval for interval in intervals if interval[0] < end and start < interval[1]]
+
+
+@pytest.mark.parametrize('n_intervals', [0, 1, 2, 3, 8, 15, 16, 17, 100, 1000])
+def test_overlaps_match_linear_scan(n_intervals):
+    rng = random.Random(n_intervals)
+    intervals = []
+    for idx in range(n_intervals):
+        start = rng.randint(0, 10 * n_intervals)
+        intervals.append((start, start + rng.randint(1, 300), f'gene{idx}'))
+    index = IntervalIndex(intervals)
+
+    assert len(index) == n_intervals
+    for _ in range(500):
+        start = rng.randint(-100, 10 * n_intervals + 400)
+        end = start + rng.randint(1, 500)
+        assert index.overlaps(start, end) == overlaps_by_scan(intervals, start, end)
+
+
+def test_overlaps_keep_duplicated_intervals_in_input_order():
+    intervals = [(10, 20, 'b'), (10, 20, 'a'), (5, 30, 'c'), (10, 20, 'd')]
+    assert IntervalIndex(intervals).overlaps(15, 16) == intervals
+
+
+def test_missing_key_gives_empty_index():
+    d_index = build_index_by_key({'chr1*+': {(10, 20): 'gene1'}})
+    assert d_index['chr1*+'].overlaps(0, 100) == [(10, 20, 'gene1')]
+    assert d_index['chr2*-'].overlaps(0, 100) == []
@@ -0,0 +1,46 @@
+import random
+
+import pytest
+
+from flic_utils.intron_compare import compare_intron_chains, compare_introns, compare_introns_pairwise
+from flic_utils.junctions import JunctionTable
+
+
+def make_isoforms(rng, n_isoforms, n_sites):
+    '''
+    Isoforms of one gene as (start, introns, end): introns join random splice sites of a shared pool,
+    so the isoforms share, shift, skip and retain introns of each other
+    '''
+    sites = sorted(rng.sample(range(100, 100 + 10 * n_sites), n_sites))
+    iso_l = []
+    for _ in range(n_isoforms):
+        n_introns = rng.randint(0, n_sites // 2)
+        borders = sorted(rng.sample(sites, 2 * n_introns))
+        introns = [(borders[idx], borders[idx + 1]) for idx in range(0, len(borders), 2)]
+        start = rng.randint(0, borders[0] if borders else 100)
+        end = rng.randint(borders[-1] if borders else 100, 200 + 10 * n_sites)
+        iso_l.append((start, introns, end))
+    return iso_l
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_fast_comparisons_match_pairwise(seed):
+    rng = random.Random(seed)
+    junctions = JunctionTable()
+    iso_l = make_isoforms(rng, 12, rng.randint(2, 24))
+    chains = [junctions.intern_chain('chr1', '+', introns) for _, introns, _ in iso_l]
+
+    for major_chain, (_, major_introns, _) in zip(chains, iso_l):
+        for compared_chain, (compared_start, compared_introns, compared_end) in zip(chains, iso_l):
+            expected = compare_introns_pairwise(major_introns, compared_introns, compared_start, compared_end)
+            assert compare_introns(major_introns, compared_introns, compared_start, compared_end) == expected
+            assert compare_intron_chains(major_chain, compared_chain, compared_start, compared_end,
+                                         junctions) == expected
+
+
+def test_junction_ids_are_shared_within_chrom_and_strand_only():
+    junctions = JunctionTable()
+    chain = junctions.intern_chain('chr1', '+', [(10, 20), (30, 40)])
+    assert junctions.intern_chain('chr1', '+', [(30, 40)]) == chain[1:]
+    assert junctions.find_chain('chr1', '-', [(10, 20)]) is None
+    assert junctions.get_introns(chain) == [(10, 20), (30, 40)]